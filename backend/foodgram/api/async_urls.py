@@ -0,0 +1,22 @@
+from django.urls import path
+
+from api import async_views
+
+urlpatterns = [
+    path('recipes/', async_views.recipe_list, name='recipes-list'),
+    path(
+        'recipes/download_shopping_cart/',
+        async_views.download_shopping_cart,
+        name='download-shopping-cart'),
+    path(
+        'recipes/shopping_list/', async_views.shopping_list,
+        name='shopping-list'),
+    path('tags/', async_views.tag_list, name='tags-list'),
+    path('tags/<int:pk>/', async_views.tag_detail, name='tags-detail'),
+    path(
+        'ingredients/', async_views.ingredient_list,
+        name='ingredients-list'),
+    path(
+        'ingredients/<int:pk>/', async_views.ingredient_detail,
+        name='ingredients-detail'),
+]
@@ -0,0 +1,122 @@
+"""
+Асинхронные представления эндпоинтов чтения для развертывания через ASGI.
+
+В Django 3.2 ORM синхронная, а sync_to_async с thread_sensitive выполняет
+все вызовы в одном общем потоке. Поэтому работа с базой идет в
+собственных ограниченных пулах потоков: цикл событий свободен, пока
+запросы ждут базу, а одновременных соединений не больше
+ASYNC_ORM_WORKERS на пул.
+"""
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import prefetch_related_objects
+from django.http import HttpResponse
+
+from .shopping_list import shopping_list_queryset
+from .views import (DownloadShoppingCart, IngredientViewSet, RecipeViewSet,
+                    ShoppingListView, TagViewSet)
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name):
+    with _executors_lock:
+        if name not in _executors:
+            _executors[name] = ThreadPoolExecutor(
+                max_workers=settings.ASYNC_ORM_WORKERS,
+                thread_name_prefix=f'orm-{name}')
+    return _executors[name]
+
+
+def call_in_worker(func, *args, **kwargs):
+    # Как request_started и request_finished для потока обработчика.
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def submit(pool, func, *args, **kwargs):
+    """Запускает func в пуле с контекстом текущего запроса (метрики)."""
+    context = contextvars.copy_context()
+    return get_executor(pool).submit(
+        context.run, call_in_worker, func, *args, **kwargs)
+
+
+async def run_sync(func, *args, **kwargs):
+    return await asyncio.wrap_future(submit('views', func, *args, **kwargs))
+
+
+def prefetch_concurrently(instances, lookups):
+    """Каждый prefetch выполняется отдельным запросом параллельно."""
+    if not instances or not lookups:
+        return
+    for instance in instances:
+        # Общий словарь заранее: потоки пишут в него разные ключи.
+        instance._prefetched_objects_cache = {}
+    futures = [submit('prefetch', prefetch_related_objects, instances, lookup)
+               for lookup in lookups[1:]]
+    prefetch_related_objects(instances, lookups[0])
+    for future in futures:
+        future.result()
+
+
+def render_response(view, request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    if hasattr(response, 'render'):
+        # Иначе Django отрисует ответ в общем потоке thread_sensitive.
+        response.render()
+    return response
+
+
+def async_view(view):
+    """Асинхронная обертка над синхронным представлением DRF."""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        return await run_sync(
+            render_response, view, request, *args, **kwargs)
+    return wrapper
+
+
+class ConcurrentRecipeViewSet(RecipeViewSet):
+    """Авторы, теги и ингредиенты страницы загружаются одновременно."""
+    def paginate_queryset(self, queryset):
+        lookups = queryset._prefetch_related_lookups
+        page = super().paginate_queryset(queryset.prefetch_related(None))
+        prefetch_concurrently(page, lookups)
+        return page
+
+
+class BufferedDownloadShoppingCart(DownloadShoppingCart):
+    """
+    Под ASGI тело потокового ответа читается в цикле событий, где ORM
+    недоступна, поэтому файл собирается целиком в пуле потоков. Пустая
+    корзина видна по пустому списку, отдельный запрос не нужен.
+    """
+    def export(self, user, render, content_type):
+        rows = list(shopping_list_queryset(user))
+        if not rows:
+            return None
+        return HttpResponse(render(rows), content_type=content_type)
+
+
+recipe_list = async_view(ConcurrentRecipeViewSet.as_view(
+    {'get': 'list', 'post': 'create'}, basename='recipes', detail=False))
+tag_list = async_view(TagViewSet.as_view(
+    {'get': 'list'}, basename='tags', detail=False))
+tag_detail = async_view(TagViewSet.as_view(
+    {'get': 'retrieve'}, basename='tags', detail=True))
+ingredient_list = async_view(IngredientViewSet.as_view(
+    {'get': 'list'}, basename='ingredients', detail=False))
+ingredient_detail = async_view(IngredientViewSet.as_view(
+    {'get': 'retrieve'}, basename='ingredients', detail=True))
+download_shopping_cart = async_view(BufferedDownloadShoppingCart.as_view())
+shopping_list = async_view(ShoppingListView.as_view())
@@ -0,0 +1,80 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.authentication import TokenAuthentication
+
+SHARED_KEY = 'auth-token:{}'
+
+
+class TokenUserCache:
+    """
+    LRU «токен -> пользователь» в памяти процесса с временем жизни.
+
+    Другие процессы об удалении токена не узнают, поэтому запись живет не
+    дольше AUTH_TOKEN_CACHE_TTL секунд. С AUTH_TOKEN_SHARED_CACHE запись
+    дублируется в общий кеш и удаляется из него при выходе и блокировке.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                user, expires = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    return user
+                del self._entries[key]
+        if settings.AUTH_TOKEN_SHARED_CACHE:
+            user = cache.get(SHARED_KEY.format(key))
+            if user is not None:
+                self._store(key, user)
+            return user
+        return None
+
+    def set(self, key, user):
+        self._store(key, user)
+        if settings.AUTH_TOKEN_SHARED_CACHE:
+            cache.set(SHARED_KEY.format(key), user,
+                      settings.AUTH_TOKEN_CACHE_TTL)
+
+    def _store(self, key, user):
+        with self._lock:
+            self._entries[key] = (
+                user, time.monotonic() + settings.AUTH_TOKEN_CACHE_TTL)
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.AUTH_TOKEN_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+        if settings.AUTH_TOKEN_SHARED_CACHE:
+            cache.delete_many([SHARED_KEY.format(key) for key in keys])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenUserCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication без запроса к базе для недавно виденных токенов."""
+    def authenticate_credentials(self, key):
+        user = token_cache.get(key)
+        if user is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, copy.copy(user))
+            return user, token
+        # Копия: объект из кеша не должен меняться между запросами.
+        user = copy.copy(user)
+        return user, self.get_model()(key=key, user=user)
@@ -0,0 +1,119 @@
+import time
+from datetime import datetime, timezone
+from functools import partial
+
+from django.core.cache import cache
+from django.db import transaction
+from django.views.decorators.http import condition
+
+from recipes.models import Recipe
+from users.models import LISTS_MODIFIED_KEY
+
+VERSION_KEY = 'content-version:{}'
+
+
+def get_version(name):
+    """
+    Версия раздела: время последнего изменения в секундах.
+
+    Хранится в кеше по умолчанию; при нескольких процессах он должен быть
+    общим (файловый кеш, memcached), иначе версии процессов расходятся.
+    """
+    key = VERSION_KEY.format(name)
+    version = cache.get(key)
+    if version is None:
+        version = time.time()
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key, version)
+    return version
+
+
+def set_versions(names):
+    now = time.time()
+    cache.set_many(
+        {VERSION_KEY.format(name): now for name in names}, timeout=None)
+
+
+def bump_version(*names):
+    """
+    Новая версия разделов после коммита текущей транзакции (вне
+    транзакции - сразу). Версия, поднятая до коммита, досталась бы ответу,
+    собранному по старым строкам, и 304 подтверждали бы устаревшие данные.
+    """
+    transaction.on_commit(partial(set_versions, names))
+
+
+def version_datetime(version):
+    return datetime.fromtimestamp(version, tz=timezone.utc)
+
+
+def latest(*moments):
+    return max(moment for moment in moments if moment is not None)
+
+
+def user_marker(request):
+    """Момент изменения избранного, корзины и подписок пользователя."""
+    if request.user.is_anonymous:
+        return None
+    return (cache.get(LISTS_MODIFIED_KEY.format(request.user.pk))
+            or request.user.lists_modified)
+
+
+def user_etag(request):
+    marker = user_marker(request)
+    return f'{request.user.pk}-{marker.timestamp() if marker else ""}'
+
+
+def catalog_condition(name):
+    """Условный GET для справочника, версия которого меняется при записи."""
+    return condition(
+        etag_func=lambda request, *args, **kwargs: (
+            f'{name}-{get_version(name)}'),
+        last_modified_func=lambda request, *args, **kwargs: (
+            version_datetime(get_version(name))))
+
+
+def recipes_etag(request, *args, **kwargs):
+    return f'recipes-{get_version("recipes")}-{user_etag(request)}'
+
+
+def recipes_last_modified(request, *args, **kwargs):
+    return latest(
+        version_datetime(get_version('recipes')), user_marker(request))
+
+
+recipes_condition = condition(
+    etag_func=recipes_etag, last_modified_func=recipes_last_modified)
+
+
+def recipe_modified(request, pk):
+    """Время изменения рецепта, один запрос на обработку запроса."""
+    if not hasattr(request, '_recipe_modified'):
+        try:
+            request._recipe_modified = Recipe.objects.filter(
+                pk=pk).values_list('updated_at', flat=True).first()
+        except ValueError:
+            request._recipe_modified = None
+    return request._recipe_modified
+
+
+def recipe_etag(request, pk, *args, **kwargs):
+    modified = recipe_modified(request, pk)
+    if modified is None:
+        return None
+    # Версия раздела: переименование тега, ингредиента или автора меняет
+    # вложенные данные рецепта, не трогая его updated_at.
+    return (f'recipe-{pk}-{modified.timestamp()}-{get_version("recipes")}-'
+            f'{user_etag(request)}')
+
+
+def recipe_last_modified(request, pk, *args, **kwargs):
+    modified = recipe_modified(request, pk)
+    if modified is None:
+        return None
+    return latest(modified, version_datetime(get_version('recipes')),
+                  user_marker(request))
+
+
+recipe_condition = condition(
+    etag_func=recipe_etag, last_modified_func=recipe_last_modified)
@@ -0,0 +1,47 @@
+import heapq
+
+from django.conf import settings
+from django.db.models import Q
+
+from recipes.models import Recipe, TimelineEntry
+from users.models import Subscribe
+
+
+def after_key(id_field, after):
+    """
+    Условие «строго после» ключа (pub_date, id) при обратном порядке.
+    Отдельная граница pub_date дает индексу диапазон, иначе он читается
+    с начала.
+    """
+    pub_date, pk = after
+    return Q(pub_date__lte=pub_date) & (Q(pub_date__lt=pub_date) | Q(
+        pub_date=pub_date, **{f'{id_field}__lt': pk}))
+
+
+def feed_recipe_ids(user, size, after=None):
+    """
+    Id рецептов ленты подписок по порядку (-pub_date, -id).
+
+    Основа - диапазон ленты пользователя по индексу timeline_user_idx.
+    Рецепты авторов с числом подписчиков больше FEED_FANOUT_LIMIT в ленты
+    не раскладываются: они читаются отдельно и сливаются со страницей.
+    """
+    entries = TimelineEntry.objects.filter(user=user)
+    if after is not None:
+        entries = entries.filter(after_key('recipe_id', after))
+    keys = list(entries.order_by('-pub_date', '-recipe_id').values_list(
+        'pub_date', 'recipe_id')[:size])
+    authors = list(Subscribe.objects.filter(
+        user=user,
+        author__followers_count__gt=settings.FEED_FANOUT_LIMIT).order_by(
+            ).values_list('author_id', flat=True))
+    if authors:
+        recipes = Recipe.objects.filter(author__in=authors)
+        if after is not None:
+            recipes = recipes.filter(after_key('id', after))
+        merged = recipes.order_by('-pub_date', '-id').values_list(
+            'pub_date', 'id')[:size]
+        # Рецепты, разложенные до того, как автор перешел порог, есть в
+        # обоих источниках с одинаковым ключом.
+        keys = list(dict.fromkeys(heapq.merge(keys, merged, reverse=True)))
+    return [pk for _, pk in keys[:size]]
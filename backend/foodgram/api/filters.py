@@ -1,37 +1,91 @@
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
 from django_filters.rest_framework import FilterSet, filters
-from rest_framework.filters import SearchFilter
+from rest_framework.exceptions import ValidationError
+
+from recipes.models import Recipe, Tag
+
+from .conditional import get_version
+from .recipe_index import recipe_index
 
-from recipes.models import Favorite, Recipe, ShoppingCart
+MATCH_PATTERN = re.compile(r'(all|any|missing<=(\d+))')
+TAG_MAP_KEY = 'tag-slugs:{}'
+
+
+def tag_ids_by_slug():
+    """Соответствие slug -> id тегов, кешируется до изменения тегов."""
+    key = TAG_MAP_KEY.format(get_version('tags'))
+    tag_ids = cache.get(key)
+    if tag_ids is None:
+        tag_ids = dict(Tag.objects.values_list('slug', 'id'))
+        cache.set(key, tag_ids, timeout=None)
+    return tag_ids
 
 
 class RecipeFilter(FilterSet):
     """
     фильтрация по избранному, автору, списку покупок и тегам.
     """
-    tags = filters.AllValuesMultipleFilter(field_name='tags__slug')
+    tags = filters.CharFilter(method='filter_tags')
     is_favorited = filters.BooleanFilter(method='filter_is_favorited')
     is_in_shopping_cart = filters.BooleanFilter(
         method='filter_is_in_shopping_cart'
     )
+    search = filters.CharFilter(method='filter_search')
+    ingredients = filters.CharFilter(method='filter_ingredients')
 
     class Meta:
         model = Recipe
-        fields = ('tags', 'author', 'is_favorited', 'is_in_shopping_cart')
+        fields = ('tags', 'author', 'is_favorited', 'is_in_shopping_cart',
+                  'search', 'ingredients')
+
+    def filter_tags(self, queryset, name, value):
+        tag_ids = tag_ids_by_slug()
+        slugs = self.data.getlist(name)
+        unknown = [slug for slug in slugs if slug not in tag_ids]
+        if unknown:
+            raise ValidationError(
+                {name: f'Неизвестные теги: {", ".join(unknown)}'})
+        return queryset.filter(Exists(Recipe.tags.through.objects.filter(
+            recipe_id=OuterRef('pk'),
+            tag_id__in=[tag_ids[slug] for slug in slugs])))
 
     def filter_is_favorited(self, queryset, name, value):
-        reс_pk = Favorite.objects.filter(
-            recipe_fev=self.request.user).values('recipe_id')
         if value:
-            return queryset.filter(pk__in=reс_pk)
+            return queryset.filter(is_favorited=True)
         return queryset
 
     def filter_is_in_shopping_cart(self, queryset, name, value):
-        reс_pk = ShoppingCart.objects.filter(
-            user=self.request.user).values('recipe_id')
         if value:
-            return queryset.filter(pk__in=reс_pk)
+            return queryset.filter(is_in_shopping_cart=True)
         return queryset
 
+    def filter_search(self, queryset, name, value):
+        return queryset.search(value)
 
-class IngredientSearchFilter(SearchFilter):
-    search_param = 'name'
+    def filter_ingredients(self, queryset, name, value):
+        """
+        ?ingredients=1,5,9&match=all|any|missing<=2 по индексу в памяти.
+        """
+        try:
+            ingredient_ids = [int(pk) for pk in value.split(',')]
+        except ValueError:
+            raise ValidationError(
+                {'ingredients': 'Укажите id ингредиентов через запятую'})
+        match = MATCH_PATTERN.fullmatch(self.data.get('match', 'all'))
+        if match is None:
+            raise ValidationError(
+                {'match': 'Допустимые значения: all, any, missing<=N'})
+        mode, missing = match.group(1), match.group(2)
+        if missing is not None:
+            mode, missing = 'missing', int(missing)
+        recipe_ids = recipe_index.match(ingredient_ids, mode, missing or 0)
+        if len(recipe_ids) > settings.RECIPE_MATCH_LIMIT:
+            # Список id уходит в запрос целиком, поэтому он ограничен
+            # самыми новыми рецептами; ответ помечается флагом truncated.
+            recipe_ids = recipe_ids[-settings.RECIPE_MATCH_LIMIT:]
+            self.request.recipe_match_truncated = True
+        return queryset.filter(pk__in=recipe_ids)
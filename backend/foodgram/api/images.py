@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils import timezone
+from PIL import Image
+
+from recipes.models import Recipe
+
+from .conditional import bump_version
+
+logger = logging.getLogger(__name__)
+
+# Наибольшая сторона копии в пикселях.
+IMAGE_VARIANTS = {'thumbnail': 320, 'card': 640, 'full': 1280}
+IMAGE_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+VARIANTS_DIR = 'recipes/variants'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.IMAGE_WORKERS,
+                thread_name_prefix='recipe-images')
+    return _executor
+
+
+def render_variants(image_name):
+    """Сохраняет копии фотографии во всех размерах и форматах."""
+    stem = os.path.splitext(os.path.basename(image_name))[0]
+    variants = {}
+    with default_storage.open(image_name) as source:
+        with Image.open(source) as image:
+            image = image.convert('RGB')
+    for variant, size in IMAGE_VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail((size, size))
+        for extension, image_format in IMAGE_FORMATS.items():
+            buffer = BytesIO()
+            resized.save(buffer, image_format, quality=settings.IMAGE_QUALITY)
+            variants.setdefault(variant, {})[extension] = (
+                default_storage.save(
+                    f'{VARIANTS_DIR}/{stem}-{variant}.{extension}',
+                    ContentFile(buffer.getvalue())))
+    return variants
+
+
+def delete_variants(variants):
+    for formats in variants.values():
+        for name in formats.values():
+            default_storage.delete(name)
+
+
+def process_recipe_image(recipe_id, image_name, stale_variants=None):
+    """
+    Записывает копии в рецепт, если его фотография не сменилась за время
+    обработки, и удаляет копии прежней фотографии.
+    """
+    try:
+        variants = render_variants(image_name)
+    except (OSError, ValueError):
+        logger.exception('Не удалось обработать %s', image_name)
+        return
+    updated = Recipe.objects.filter(pk=recipe_id, image=image_name).update(
+        image_variants=variants, updated_at=timezone.now())
+    if not updated:
+        delete_variants(variants)
+        return
+    bump_version('recipes')
+    if stale_variants:
+        delete_variants(stale_variants)
+
+
+def run_in_worker(*args):
+    try:
+        process_recipe_image(*args)
+    finally:
+        # Соединение с базой у каждого потока свое.
+        connection.close()
+
+
+def schedule_image_processing(recipe, stale_variants=None):
+    """Ставит обработку в очередь после фиксации транзакции."""
+    args = (recipe.pk, recipe.image.name, stale_variants)
+    if not settings.IMAGE_WORKERS:
+        transaction.on_commit(lambda: process_recipe_image(*args))
+        return
+    transaction.on_commit(
+        lambda: get_executor().submit(run_in_worker, *args))
+
+
+def variant_url(request, recipe, variant='thumbnail', extension='jpeg'):
+    name = recipe.image_variants.get(variant, {}).get(extension)
+    if not name:
+        return None
+    url = default_storage.url(name)
+    return request.build_absolute_uri(url) if request else url
@@ -0,0 +1,60 @@
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+from recipes.models import Ingredient
+
+
+class IngredientPrefixIndex:
+    """
+    Отсортированный индекс названий ингредиентов в памяти процесса.
+
+    Загружается один раз при первом обращении и сбрасывается сигналами
+    при сохранении или удалении ингредиента. Массовая загрузка и другие
+    процессы сигналов не присылают, поэтому индекс также перечитывается
+    раз в INGREDIENT_INDEX_TTL секунд.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+
+    def _load(self):
+        with self._lock:
+            if self._index is None or self._expired(self._index):
+                items = sorted(
+                    Ingredient.objects.values(
+                        'id', 'name', 'measurement_unit').iterator(),
+                    key=lambda item: (item['name'].lower(), item['id']))
+                keys = [item['name'].lower() for item in items]
+                self._index = (keys, items, time.monotonic())
+            return self._index
+
+    def _expired(self, index):
+        return time.monotonic() - index[2] > settings.INGREDIENT_INDEX_TTL
+
+    def invalidate(self):
+        self._index = None
+
+    def search(self, prefix=None, limit=None):
+        index = self._index
+        if index is None or self._expired(index):
+            index = self._load()
+        keys, items, _ = index
+        if not prefix:
+            return items
+        if limit is None:
+            limit = settings.INGREDIENT_SEARCH_LIMIT
+        prefix = prefix.lower()
+        start = bisect_left(keys, prefix)
+        result = []
+        for key, item in zip(keys[start:start + limit],
+                             items[start:start + limit]):
+            if not key.startswith(prefix):
+                break
+            result.append(item)
+        return result
+
+
+ingredient_index = IngredientPrefixIndex()
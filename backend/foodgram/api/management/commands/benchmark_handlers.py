@@ -0,0 +1,129 @@
+import asyncio
+import sys
+import time
+from io import BytesIO
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+HOST = 'localhost'
+DEFAULT_PATHS = ('/api/tags/', '/api/ingredients/', '/api/recipes/')
+
+
+def wsgi_environ(path, query, headers):
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': HOST,
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': HOST,
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': BytesIO(),
+        'wsgi.errors': sys.stderr,
+    }
+    for name, value in headers.items():
+        environ[f'HTTP_{name.upper().replace("-", "_")}'] = value
+    return environ
+
+
+def asgi_scope(path, query, headers):
+    return {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'query_string': query.encode(),
+        'headers': [(b'host', HOST.encode())] + [
+            (name.lower().encode(), value.encode())
+            for name, value in headers.items()],
+        'server': (HOST, 80),
+        'client': ('127.0.0.1', 0),
+    }
+
+
+class Command(BaseCommand):
+    help = ('compare WSGI and ASGI throughput of read endpoints '
+            'in one process, i.e. on one core.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path', action='append', dest='paths',
+            help='Путь с query-строкой; можно указать несколько раз.')
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument(
+            '--concurrency', type=int, default=16,
+            help='Одновременных запросов к ASGI; синхронный воркер '
+                 'gunicorn обрабатывает по одному.')
+        parser.add_argument('--token', help='Токен для авторизации.')
+
+    def handle(self, *args, **options):
+        headers = {}
+        if options['token']:
+            headers['Authorization'] = f'Token {options["token"]}'
+        for url in options['paths'] or DEFAULT_PATHS:
+            path, _, query = url.partition('?')
+            with override_settings(ROOT_URLCONF='foodgram.urls'):
+                wsgi = self.measure(
+                    self.run_wsgi, path, query, headers, options)
+            with override_settings(ROOT_URLCONF='foodgram.asgi_urls'):
+                asgi = self.measure(
+                    self.run_asgi, path, query, headers, options)
+            for name, result in (('wsgi', wsgi), ('asgi', asgi)):
+                self.stdout.write(f'{url} {name}: {self.report(*result)}')
+
+    def measure(self, run, path, query, headers, options):
+        wall, cpu = time.perf_counter(), time.process_time()
+        errors = run(path, query, headers, options)
+        return (options['requests'], time.perf_counter() - wall,
+                time.process_time() - cpu, errors)
+
+    def report(self, requests, wall, cpu, errors):
+        # Процессорное время всего процесса, включая пулы потоков ORM:
+        # запросов на секунду CPU - пропускная способность одного ядра.
+        line = (f'{requests / wall:.1f} запросов/с, '
+                f'{requests / max(cpu, 1e-9):.1f} запросов на секунду CPU')
+        if errors:
+            line += f', ошибок: {errors}'
+        return line
+
+    def run_wsgi(self, path, query, headers, options):
+        handler = WSGIHandler()
+        statuses = []
+
+        def start_response(status, response_headers, exc_info=None):
+            statuses.append(int(status.split()[0]))
+
+        for _ in range(options['requests']):
+            body = handler(wsgi_environ(path, query, headers), start_response)
+            b''.join(body)
+            body.close()
+        return sum(status >= 400 for status in statuses)
+
+    def run_asgi(self, path, query, headers, options):
+        return asyncio.run(self.asgi_requests(path, query, headers, options))
+
+    async def asgi_requests(self, path, query, headers, options):
+        handler = ASGIHandler()
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        statuses = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+
+        async def request():
+            async with semaphore:
+                await handler(asgi_scope(path, query, headers), receive, send)
+
+        await asyncio.gather(
+            *(request() for _ in range(options['requests'])))
+        return sum(status >= 400 for status in statuses)
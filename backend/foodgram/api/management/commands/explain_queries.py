@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.query_plans import RANGE_QUERIES, canonical_queries, plan_issues
+from recipes.models import ShoppingCart
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = ('explain canonical endpoint queries and flag sequential scans '
+            'and sorts above the row threshold.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threshold', type=int, default=1000,
+            help='Допустимое число строк в полном просмотре или сортировке.')
+
+    def handle(self, *args, **options):
+        # Пользователь с корзиной, чтобы список покупок не был пустым.
+        cart = ShoppingCart.objects.only('user').first()
+        user = cart.user if cart else User.objects.order_by('pk').first()
+        if user is None:
+            raise CommandError('Нет пользователей для проверки запросов')
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            self.stdout.write(f'Планы для {connection.vendor} не проверяются')
+            return
+        problems = 0
+        for name, queryset in canonical_queries(user):
+            issues = plan_issues(queryset, options['threshold'],
+                                 ranged=name in RANGE_QUERIES)
+            problems += len(issues)
+            status = 'ok' if not issues else '; '.join(issues)
+            self.stdout.write(f'{name}: {status}')
+        if problems:
+            raise CommandError(f'Проблемных узлов плана: {problems}')
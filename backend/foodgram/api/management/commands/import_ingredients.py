@@ -1,24 +1,97 @@
 import csv
+import json
 import os
+import time
+from collections import Counter
+from itertools import islice
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.conditional import bump_version
+from api.ingredient_index import ingredient_index
 from recipes.models import Ingredient
 
 FILE2IMPORT = os.path.join(settings.DATAFILES_DIRS[0], 'data/ingredients.csv')
+JSON_CHUNK_SIZE = 64 * 1024
+
+
+def read_csv(file):
+    for row in csv.DictReader(file, delimiter=','):
+        yield row['name'], row['measurement_unit']
+
+
+def read_json(file):
+    """Потоково разбирает JSON-массив объектов, не загружая файл целиком."""
+    decoder = json.JSONDecoder()
+    buffer = file.read(JSON_CHUNK_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise CommandError('Ожидается JSON-массив ингредиентов')
+    buffer = buffer[1:]
+    while True:
+        buffer = buffer.lstrip().lstrip(',').lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            row, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            chunk = file.read(JSON_CHUNK_SIZE)
+            if not chunk:
+                raise CommandError('Файл JSON обрывается')
+            buffer += chunk
+            continue
+        yield row['name'], row['measurement_unit']
+        buffer = buffer[end:]
+
+
+READERS = {'.csv': read_csv, '.json': read_json}
 
 
 class Command(BaseCommand):
-    help = 'load ingredients from csv. data folder must be placed in static.'
+    help = ('load ingredients from csv or json. '
+            'data folder must be placed in static.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=FILE2IMPORT)
+        parser.add_argument('--batch-size', type=int, default=1000)
 
     def handle(self, *args, **options):
-        with open(FILE2IMPORT, encoding='utf-8') as csv_file:
-            csv_reader = csv.DictReader(csv_file, delimiter=',')
-            for row in csv_reader:
-                name = row['name']
-                measurement_unit = row['measurement_unit']
-                ingredients = Ingredient(
-                    name=name,
-                    measurement_unit=measurement_unit
-                )
-                ingredients.save()
+        path = options['path']
+        reader = READERS.get(os.path.splitext(path)[1].lower())
+        if reader is None:
+            raise CommandError('Поддерживаются только файлы .csv и .json')
+        stats = Counter()
+        start = time.perf_counter()
+        before = Ingredient.objects.count()
+        with open(path, encoding='utf-8') as file, transaction.atomic():
+            ingredients = self.clean(reader(file), stats)
+            while True:
+                batch = list(islice(ingredients, options['batch_size']))
+                if not batch:
+                    break
+                Ingredient.objects.bulk_create(batch, ignore_conflicts=True)
+        ingredient_index.invalidate()
+        bump_version('ingredients', 'recipes')
+        elapsed = time.perf_counter() - start
+        created = Ingredient.objects.count() - before
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано {stats["total"]} строк за {elapsed:.2f} с '
+            f'({stats["total"] / elapsed:.0f} строк/с): '
+            f'добавлено {created}, '
+            f'уже было {stats["total"] - stats["skipped"] - created}, '
+            f'пропущено {stats["skipped"]}'))
+
+    def clean(self, rows, stats):
+        name_length = Ingredient._meta.get_field('name').max_length
+        unit_length = Ingredient._meta.get_field(
+            'measurement_unit').max_length
+        for name, measurement_unit in rows:
+            stats['total'] += 1
+            name = name.strip()
+            measurement_unit = measurement_unit.strip()
+            if (not name or len(name) > name_length
+                    or len(measurement_unit) > unit_length):
+                stats['skipped'] += 1
+                continue
+            yield Ingredient(name=name, measurement_unit=measurement_unit)
@@ -0,0 +1,93 @@
+from collections import defaultdict
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+
+from api.conditional import bump_version
+from api.ingredient_index import ingredient_index
+from api.toggles import delete_rows
+from recipes.models import Ingredient, IngredientRecipe, ShoppingListItem
+
+BATCH_SIZE = 1000
+# Верхняя граница PositiveSmallIntegerField на всех СУБД.
+MAX_AMOUNT = 32767
+
+
+def duplicates():
+    """{id дубля: id оставляемого ингредиента с наименьшим id}."""
+    survivors, mapping = {}, {}
+    for pk, name, unit in Ingredient.objects.filter(Exists(
+            Ingredient.objects.filter(
+                name=OuterRef('name'),
+                measurement_unit=OuterRef('measurement_unit')).exclude(
+                    pk=OuterRef('pk')))).order_by('pk').values_list(
+                        'pk', 'name', 'measurement_unit'):
+        survivor = survivors.setdefault((name, unit), pk)
+        if survivor != pk:
+            mapping[pk] = survivor
+    return mapping
+
+
+def merge_ingredients(mapping):
+    """
+    Переводит строки рецептов с дублей на оставляемые ингредиенты и
+    удаляет дубли. Если в рецепте несколько строк одного ингредиента,
+    остается одна с суммой количеств. Возвращает число измененных строк.
+    """
+    rows = IngredientRecipe.objects.filter(
+        ingredient__in=list(mapping)).order_by('pk').values_list(
+            'pk', 'recipe_id', 'ingredient_id', 'amount')
+    merged = defaultdict(list)
+    for pk, recipe_id, ingredient_id, amount in rows:
+        merged[recipe_id, mapping[ingredient_id]].append((pk, amount))
+    # Строки самих оставляемых ингредиентов идут первыми и сохраняются.
+    survivor_rows = IngredientRecipe.objects.filter(
+        recipe__in={recipe_id for recipe_id, _ in merged},
+        ingredient__in=set(mapping.values())).values_list(
+            'pk', 'recipe_id', 'ingredient_id', 'amount')
+    for pk, recipe_id, ingredient_id, amount in survivor_rows:
+        if (recipe_id, ingredient_id) in merged:
+            merged[recipe_id, ingredient_id].insert(0, (pk, amount))
+    kept, extra = [], []
+    for (recipe_id, ingredient_id), group in merged.items():
+        kept.append(IngredientRecipe(
+            pk=group[0][0], ingredient_id=ingredient_id,
+            amount=min(sum(amount for _, amount in group), MAX_AMOUNT)))
+        extra.extend(pk for pk, _ in group[1:])
+    # Сначала лишние строки: иначе перевод упрется в уникальность
+    # (recipe, ingredient). Удаление без каскадов и сигналов: команда
+    # запускается до migrate, и таблиц, которые они затрагивают, может
+    # еще не быть.
+    delete_rows(IngredientRecipe, extra)
+    IngredientRecipe.objects.bulk_update(
+        kept, ['ingredient', 'amount'], batch_size=BATCH_SIZE)
+    delete_rows(Ingredient, list(mapping))
+    return len(kept) + len(extra)
+
+
+class Command(BaseCommand):
+    help = ('merge ingredients with the same name and measurement unit '
+            'left by the old importer; run before migrate adds the '
+            'unique constraint.')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        mapping = duplicates()
+        if not mapping:
+            self.stdout.write('Ingredient: дублей нет')
+            return
+        lists = (ShoppingListItem._meta.db_table
+                 in connection.introspection.table_names())
+        if lists:
+            ShoppingListItem.objects.filter(
+                ingredient__in=list(mapping)).delete()
+        changed = merge_ingredients(mapping)
+        if lists:
+            call_command('rebuild_shopping_lists', stdout=self.stdout)
+        ingredient_index.invalidate()
+        bump_version('ingredients', 'recipes')
+        self.stdout.write(
+            f'Ingredient: удалено дублей {len(mapping)}, '
+            f'исправлено строк рецептов {changed}')
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = 'rebuild full-text search documents of recipes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        total = 0
+        while True:
+            ids = list(Recipe.objects.filter(pk__gt=last_id).order_by(
+                'pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            total += Recipe.objects.filter(
+                pk__in=ids).refresh_search_documents()
+            last_id = ids[-1]
+        self.stdout.write(f'Обновлено рецептов: {total}')
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+
+from recipes.models import IngredientRecipe, ShoppingListItem
+
+BATCH_SIZE = 1000
+
+
+def expected_items():
+    """Списки покупок, посчитанные заново по корзинам и рецептам."""
+    return {
+        (user_id, ingredient_id): amount
+        for user_id, ingredient_id, amount in IngredientRecipe.objects.filter(
+            recipe__shopping_carts__isnull=False).order_by().values_list(
+                'recipe__shopping_carts__user', 'ingredient').annotate(
+                    amount=Sum('amount')).iterator()}
+
+
+class Command(BaseCommand):
+    help = ('rebuild aggregated shopping lists from carts and recipe '
+            'ingredients; with --check only verify them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Только проверить и завершиться с ошибкой при расхождении.')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        expected = expected_items()
+        stale, changed, wrong = [], [], 0
+        for item in ShoppingListItem.objects.only(
+                'id', 'user_id', 'ingredient_id', 'amount').iterator():
+            amount = expected.pop((item.user_id, item.ingredient_id), 0)
+            if item.amount != amount:
+                wrong += 1
+            if not amount:
+                # Обнуленные строки не расхождение, но больше не нужны.
+                stale.append(item.pk)
+            elif item.amount != amount:
+                item.amount = amount
+                changed.append(item)
+        wrong += len(expected)
+        if options['check']:
+            if wrong:
+                raise CommandError(f'Расходится строк списков: {wrong}')
+            self.stdout.write('Списки покупок согласованы')
+            return
+        for start in range(0, len(stale), BATCH_SIZE):
+            ShoppingListItem.objects.filter(
+                pk__in=stale[start:start + BATCH_SIZE]).delete()
+        ShoppingListItem.objects.bulk_update(
+            changed, ['amount'], batch_size=BATCH_SIZE)
+        ShoppingListItem.objects.bulk_create(
+            (ShoppingListItem(user_id=user_id, ingredient_id=ingredient_id,
+                              amount=amount)
+             for (user_id, ingredient_id), amount in expected.items()),
+            batch_size=BATCH_SIZE)
+        self.stdout.write(
+            f'ShoppingListItem: исправлено строк {wrong}, '
+            f'удалено {len(stale)}')
@@ -0,0 +1,23 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recipes.models import TimelineEntry
+from users.models import Subscribe
+
+
+class Command(BaseCommand):
+    help = ('rebuild subscription feed timelines: the latest FEED_BACKFILL '
+            'recipes of every followed author.')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        TimelineEntry.objects.all().delete()
+        authors = defaultdict(list)
+        for user_id, author_id in Subscribe.objects.order_by().values_list(
+                'user_id', 'author_id').iterator():
+            authors[user_id].append(author_id)
+        for user_id, author_ids in authors.items():
+            TimelineEntry.objects.backfill(user_id, author_ids)
+        self.stdout.write(f'TimelineEntry: собрано лент {len(authors)}')
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.models import Favorite, Recipe, ShoppingCart
+from users.models import Subscribe, User
+
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'shopping_carts_count', ShoppingCart, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'followers_count', Subscribe, 'author'),
+)
+
+
+def count_of(model, field):
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')}).order_by().values(
+            field).annotate(count=Count('pk')).values('count')), 0)
+
+
+class Command(BaseCommand):
+    help = 'recount denormalized favorite, cart, recipe and follower counters.'
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        for model, counter, related_model, field in COUNTERS:
+            actual = count_of(related_model, field)
+            fixed = model.objects.exclude(**{counter: actual}).update(
+                **{counter: actual})
+            self.stdout.write(
+                f'{model.__name__}.{counter}: исправлено строк {fixed}')
@@ -0,0 +1,171 @@
+"""
+Метрики производительности запросов в памяти процесса.
+
+Каждый процесс gunicorn копит свои значения; Prometheus собирает их с
+того процесса, который ответил на запрос /api/_metrics.
+"""
+import hashlib
+import logging
+import threading
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from time import perf_counter
+
+from .response_cache import stats as response_cache_stats
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+current_metrics = ContextVar('current_metrics', default=None)
+
+
+class RequestMetrics:
+    """Счетчики одного запроса: SQL, сериализация, повторы запросов."""
+    def __init__(self):
+        # Под ASGI запросы одного ответа выполняются в нескольких потоках.
+        self._lock = threading.Lock()
+        self.queries = Counter()
+        self.sql_time = 0.0
+        self.serializer_time = 0.0
+        self.serializing = False
+
+    def record_query(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.sql_time += perf_counter() - start
+                # Параметры передаются отдельно, текст запроса и есть
+                # отпечаток.
+                self.queries[sql] += 1
+
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+
+    def duplicates(self):
+        return {sql: count for sql, count in self.queries.items()
+                if count > 1}
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Обертка всех соединений: запрос учитывается в метриках того HTTP-запроса,
+    в контексте которого он выполнен, в каком бы потоке это ни было.
+    """
+    metrics = current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics.record_query(execute, sql, params, many, context)
+
+
+class TimedSerializerMixin:
+    """Учитывает время to_representation внешнего сериализатора."""
+    def to_representation(self, instance):
+        metrics = current_metrics.get()
+        if metrics is None or metrics.serializing:
+            return super().to_representation(instance)
+        metrics.serializing = True
+        start = perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            metrics.serializer_time += perf_counter() - start
+            metrics.serializing = False
+
+
+def fingerprint(sql):
+    return hashlib.sha1(sql.encode()).hexdigest()[:12]
+
+
+def escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.values = defaultdict(lambda: [[0] * len(buckets), 0.0, 0])
+
+    def observe(self, view, value):
+        entry = self.values[view]
+        position = bisect_left(self.buckets, value)
+        if position < len(self.buckets):
+            entry[0][position] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for view, (counts, total, count) in sorted(self.values.items()):
+            label = f'view="{escape(view)}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (f'{self.name}_bucket{{{label},le="{bound}"}} '
+                       f'{cumulative}')
+            yield f'{self.name}_bucket{{{label},le="+Inf"}} {count}'
+            yield f'{self.name}_sum{{{label}}} {total}'
+            yield f'{self.name}_count{{{label}}} {count}'
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.duration = Histogram(
+            'foodgram_request_duration_seconds',
+            'Полное время обработки запроса.', LATENCY_BUCKETS)
+        self.sql_time = Histogram(
+            'foodgram_request_sql_seconds',
+            'Время SQL-запросов за запрос.', LATENCY_BUCKETS)
+        self.serializer_time = Histogram(
+            'foodgram_request_serializer_seconds',
+            'Время сериализации ответа.', LATENCY_BUCKETS)
+        self.queries = Histogram(
+            'foodgram_request_queries',
+            'Число SQL-запросов за запрос.', QUERY_BUCKETS)
+        self.duplicates = Counter()
+
+    def observe(self, view, metrics, duration):
+        with self._lock:
+            self.duration.observe(view, duration)
+            self.sql_time.observe(view, metrics.sql_time)
+            self.serializer_time.observe(view, metrics.serializer_time)
+            self.queries.observe(view, metrics.query_count)
+            for sql, count in metrics.duplicates().items():
+                key = (view, fingerprint(sql))
+                if key not in self.duplicates:
+                    logger.warning(
+                        'Повторяющийся запрос %s в %s: %s', key[1], view, sql)
+                self.duplicates[key] += count - 1
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for histogram in (self.duration, self.sql_time,
+                              self.serializer_time, self.queries):
+                lines.extend(histogram.render())
+            name = 'foodgram_duplicate_queries_total'
+            lines.append(
+                f'# HELP {name} Повторные выполнения одного запроса (N+1).')
+            lines.append(f'# TYPE {name} counter')
+            for (view, sql_hash), count in sorted(self.duplicates.items()):
+                lines.append(
+                    f'{name}{{view="{escape(view)}",'
+                    f'fingerprint="{sql_hash}"}} {count}')
+        for kind in ('hits', 'misses'):
+            name = f'foodgram_response_cache_{kind}_total'
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {getattr(response_cache_stats, kind)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
@@ -1,4 +1,14 @@
+from django.db import transaction
+from django.db.models import Exists, OuterRef
 from rest_framework import mixins, viewsets
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from users.models import change_counters, touch_lists
+
+from .serializers import BatchSerializer
+from .toggles import delete_rows, insert_ignoring_conflicts
 
 
 class CreateDestroyViewSet(mixins.CreateModelMixin,
@@ -8,3 +18,89 @@ class CreateDestroyViewSet(mixins.CreateModelMixin,
     Вьюсет определяющий методы POST и DELETE
     """
     pass
+
+
+class BatchToggleView(APIView):
+    """
+    Пакетное добавление (POST) и удаление (DELETE) связей пользователя с
+    объектами по списку ids с результатом для каждого id.
+
+    Вставка и удаление выполняются одним запросом без сигналов моделей,
+    поэтому их работу (счетчик counter_field, отметка изменения списков
+    пользователя) повторяет links_changed.
+    """
+    permission_classes = [IsAuthenticated, ]
+    model = None
+    target_model = None
+    user_field = None
+    target_field = None
+    counter_field = None
+
+    def get_ids(self, request):
+        serializer = BatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data['ids']
+
+    def get_links(self, user):
+        return self.model.objects.filter(**{self.user_field: user})
+
+    def links_changed(self, user, pks, delta):
+        """То, что при одиночной записи обновляют сигналы моделей."""
+        change_counters(self.target_model, pks, self.counter_field, delta)
+        touch_lists(user.pk)
+
+    def reject(self, user, pk):
+        """Статус для id, который нельзя добавить, или None."""
+        return None
+
+    def post(self, request):
+        ids = self.get_ids(request)
+        user = request.user
+        # Существование объектов и уже добавленные - одним запросом.
+        linked = dict(self.target_model.objects.filter(
+            pk__in=ids).order_by().annotate(linked=Exists(
+                self.get_links(user).filter(
+                    **{self.target_field: OuterRef('pk')}))).values_list(
+                        'pk', 'linked'))
+        results = {}
+        for pk in ids:
+            if pk not in linked:
+                results[pk] = 'not_found'
+            elif linked[pk]:
+                results[pk] = 'exists'
+            else:
+                results[pk] = self.reject(user, pk) or 'created'
+        key = f'{self.target_field}_id'
+        links = [self.model(**{self.user_field: user, key: pk})
+                 for pk, result in results.items() if result == 'created']
+        if links:
+            with transaction.atomic():
+                # Связь, которую успел добавить параллельный запрос,
+                # пропускается вставкой и не меняет счетчики второй раз.
+                created = [getattr(link, key) for link in
+                           insert_ignoring_conflicts(links, key)]
+                if created:
+                    self.links_changed(user, created, 1)
+            for link in links:
+                if getattr(link, key) not in created:
+                    results[getattr(link, key)] = 'exists'
+        return Response({'results': [
+            {'id': pk, 'status': result} for pk, result in results.items()]})
+
+    def delete(self, request):
+        ids = self.get_ids(request)
+        user = request.user
+        links = self.get_links(user).filter(
+            **{f'{self.target_field}__in': ids})
+        with transaction.atomic():
+            rows = dict(links.select_for_update().values_list(
+                'pk', f'{self.target_field}_id'))
+            deleted = set(rows.values())
+            if deleted:
+                # Одно удаление вместо удаления каждой строки ради
+                # сигналов post_delete.
+                delete_rows(self.model, rows)
+                self.links_changed(user, deleted, -1)
+        return Response({'results': [
+            {'id': pk, 'status': 'deleted' if pk in deleted else 'absent'}
+            for pk in ids]})
@@ -1,5 +1,138 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class PageLimitPagination(PageNumberPagination):
     page_size_query_param = 'limit'
+
+
+class KeysetPageLimitPagination(PageLimitPagination):
+    """
+    Постраничная пагинация с режимом курсора по запросу.
+
+    Если передан параметр cursor (для первой страницы пустой), страница
+    выбирается условием по ключу keyset вместо COUNT и OFFSET, поэтому
+    глубокие страницы стоят столько же, сколько первая.
+    """
+    cursor_query_param = 'cursor'
+    keyset = ('-pub_date', '-id')
+    invalid_cursor_message = 'Неверный курсор'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_mode = self.cursor_query_param in request.query_params
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, request, view)
+        queryset = queryset.order_by(*self.keyset)
+
+        def fetch(size, after):
+            if after is not None:
+                return list(queryset.filter(self.after(after))[:size])
+            return list(queryset[:size])
+
+        return self.paginate_cursor(request, queryset.model, fetch)
+
+    def paginate_cursor(self, request, model, fetch):
+        """
+        Страница по курсору из fetch(размер, ключ или None), который
+        возвращает объекты в порядке keyset строго после ключа.
+        """
+        self.cursor_mode = True
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        after = self.decode_cursor(cursor, model) if cursor else None
+        page = fetch(page_size + 1, after)
+        self.next_cursor = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_cursor = self.encode_cursor(page[-1])
+        return page
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return super().get_next_link()
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param, self.next_cursor)
+
+    def after(self, values):
+        """
+        Лексикографическое условие «строго после» для ключа keyset.
+
+        Граница по первому полю дублируется отдельным условием: по одному
+        OR индекс не получает диапазона и читается с начала.
+        """
+        condition = Q()
+        equal = {}
+        for field, value in zip(self.keyset, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        if len(self.keyset) > 1:
+            first = self.keyset[0]
+            lookup = 'lte' if first.startswith('-') else 'gte'
+            condition &= Q(**{f'{first.lstrip("-")}__{lookup}': values[0]})
+        return condition
+
+    def encode_cursor(self, obj):
+        values = [obj._meta.get_field(field.lstrip('-')).value_to_string(obj)
+                  for field in self.keyset]
+        return base64.urlsafe_b64encode(
+            json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, cursor, model):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if len(values) != len(self.keyset):
+                raise ValueError
+            return [model._meta.get_field(field.lstrip('-')).to_python(value)
+                    for field, value in zip(self.keyset, values)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+class SubscriptionsPagination(KeysetPageLimitPagination):
+    keyset = ('id',)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Пагинатор админки: для нефильтрованных больших таблиц в PostgreSQL
+    берет оценку числа строк из статистики вместо COUNT(*).
+    """
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples FROM pg_class WHERE relname = %s',
+                    [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > self.estimate_threshold:
+                return int(row[0])
+        return super().count
@@ -0,0 +1,134 @@
+"""
+Проверка планов запросов, которые выполняют эндпоинты.
+
+PostgreSQL оценивает строки сам; SQLite оценок не дает, поэтому для него
+берется размер таблицы. Другие СУБД не проверяются.
+"""
+import json
+import re
+
+from django.db import connections
+from django.db.models import Exists, OuterRef, Q
+
+from recipes.models import IngredientRecipe, Recipe, Tag, TimelineEntry
+from users.models import Subscribe
+
+from .feed import after_key
+from .paginators import KeysetPageLimitPagination
+from .shopping_list import shopping_list_queryset
+
+FEED_ORDER = ('-pub_date', '-id')
+PAGE_SIZE = 6
+SQLITE_SCAN = re.compile(r'\bSCAN (\w+)(.*)')
+# Страницы по курсору: индекс базовой таблицы должен читаться от границы
+# диапазона, а не с начала (или с начала префикса, например user_id) с
+# отбрасыванием строк до курсора.
+RANGE_QUERIES = frozenset({'recipes?cursor', 'feed?cursor'})
+SQLITE_SEARCH = re.compile(r'\bSEARCH (\w+) USING .*INDEX (\w+) \((.*)\)')
+RANGE_CONDITION = re.compile(r'[<>]')
+SQLITE_SORT = re.compile(r'USE TEMP B-TREE FOR (ORDER BY|GROUP BY|DISTINCT)')
+
+
+def canonical_queries(user):
+    """Основные запросы эндпоинтов для пользователя с данными."""
+    feed = Recipe.objects.with_user_data(user).order_by(*FEED_ORDER)
+    keys = list(feed.values_list('pub_date', 'pk')[:PAGE_SIZE])
+    recipe_ids = [pk for _, pk in keys]
+    cursor = KeysetPageLimitPagination().after(keys[-1]) if keys else Q()
+    timeline = TimelineEntry.objects.filter(user=user).order_by(
+        '-pub_date', '-recipe_id').values_list('pub_date', 'recipe_id')
+    timeline_keys = list(timeline[:PAGE_SIZE])
+    timeline_cursor = (after_key('recipe_id', timeline_keys[-1])
+                       if timeline_keys else Q())
+    tag_ids = list(Tag.objects.values_list('pk', flat=True)[:2])
+    return (
+        ('recipes', feed[:PAGE_SIZE]),
+        ('recipes?cursor', feed.filter(cursor)[:PAGE_SIZE]),
+        ('recipes?author', feed.filter(author=user)[:PAGE_SIZE]),
+        ('recipes?tags', feed.filter(Exists(
+            Recipe.tags.through.objects.filter(
+                recipe_id=OuterRef('pk'), tag_id__in=tag_ids)))[:PAGE_SIZE]),
+        ('recipes?is_favorited', feed.filter(is_favorited=True)[:PAGE_SIZE]),
+        ('recipes?is_in_shopping_cart',
+         feed.filter(is_in_shopping_cart=True)[:PAGE_SIZE]),
+        ('recipes: ingredients', IngredientRecipe.objects.filter(
+            recipe__in=recipe_ids).select_related('ingredient')),
+        ('recipes: tags', Tag.objects.filter(recipe__in=recipe_ids)),
+        ('download_shopping_cart', shopping_list_queryset(user)),
+        ('subscriptions', Subscribe.objects.filter(user=user).select_related(
+            'author').order_by('id')[:PAGE_SIZE]),
+        ('feed?cursor', timeline.filter(timeline_cursor)[:PAGE_SIZE]),
+    )
+
+
+def postgresql_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from postgresql_nodes(child)
+
+
+def postgresql_issues(queryset, threshold, ranged):
+    connection = connections[queryset.db]
+    plan = json.loads(queryset.explain(format='json'))[0]['Plan']
+    base_table = queryset.model._meta.db_table
+    for node in postgresql_nodes(plan):
+        rows = node['Plan Rows']
+        if (ranged and node['Node Type'] in ('Index Scan', 'Index Only Scan')
+                and node['Relation Name'] == base_table
+                and not RANGE_CONDITION.search(node.get('Index Cond', ''))):
+            yield f'{node["Node Type"]} {node["Index Name"]} без диапазона'
+        elif node['Node Type'] == 'Seq Scan':
+            relation = node['Relation Name']
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples FROM pg_class WHERE relname = %s',
+                    (relation,))
+                rows = max(rows, int(cursor.fetchone()[0]))
+            if rows > threshold:
+                yield f'Seq Scan {relation}: ~{rows} строк'
+        elif node['Node Type'].endswith('Sort') and rows > threshold:
+            yield f'{node["Node Type"]}: ~{rows} строк'
+
+
+def sqlite_issues(queryset, threshold, ranged):
+    connection = connections[queryset.db]
+    tables = set(connection.introspection.table_names())
+    base_table = queryset.model._meta.db_table
+
+    def table_rows(table):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM "{table}"')
+            return cursor.fetchone()[0]
+
+    for line in queryset.explain().splitlines():
+        scan = SQLITE_SCAN.search(line)
+        if scan and (ranged or 'INDEX' not in scan.group(2)):
+            # Псевдонимы подзапросов (U0, T3) относятся к базовой таблице.
+            table = scan.group(1) if scan.group(1) in tables else base_table
+            rows = table_rows(table)
+            if rows > threshold:
+                yield f'SCAN {table}{scan.group(2)}: {rows} строк'
+        search = SQLITE_SEARCH.search(line)
+        if (ranged and search and search.group(1) == base_table
+                and not RANGE_CONDITION.search(search.group(3))):
+            yield (f'SEARCH {base_table} USING INDEX {search.group(2)} '
+                   f'без диапазона: ({search.group(3)})')
+        sort = SQLITE_SORT.search(line)
+        if sort:
+            rows = table_rows(base_table)
+            if rows > threshold:
+                yield f'TEMP B-TREE FOR {sort.group(1)}: до {rows} строк'
+
+
+CHECKERS = {'postgresql': postgresql_issues, 'sqlite': sqlite_issues}
+
+
+def plan_issues(queryset, threshold, ranged=False):
+    """
+    Полные просмотры и сортировки больше threshold строк. С ranged
+    полным считается и просмотр индекса без условия диапазона.
+    """
+    checker = CHECKERS.get(connections[queryset.db].vendor)
+    if checker is None:
+        return []
+    return list(checker(queryset, threshold, ranged))
@@ -0,0 +1,168 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from datetime import timedelta
+from itertools import chain
+
+from django.conf import settings
+from django.db.models import Max
+
+from recipes.models import IngredientRecipe, Recipe
+
+from .conditional import get_version
+
+EMPTY = array('q')
+# Запас на транзакции, зафиксированные позже своего updated_at.
+DELTA_OVERLAP = timedelta(seconds=60)
+
+
+def contains(posting, recipe_id):
+    position = bisect_left(posting, recipe_id)
+    return position < len(posting) and posting[position] == recipe_id
+
+
+def patched(groups, removed, added, build):
+    """Копия groups, где у затронутых ключей убраны и добавлены id."""
+    groups = dict(groups)
+    for key in removed.keys() | added.keys():
+        groups[key] = build(
+            set(groups.get(key, ())) - removed[key] | added[key])
+    return groups
+
+
+class RecipeIngredientIndex:
+    """
+    Инвертированный индекс «ингредиент -> id рецептов» в памяти процесса.
+
+    Списки рецептов хранятся отсортированными массивами, рядом - рецепты
+    по числу ингредиентов для режима missing. При смене версии
+    рецептов перечитываются только рецепты с updated_at новее последней
+    загрузки, а раз в RECIPE_INDEX_TTL секунд индекс загружается целиком
+    и забывает удаленные рецепты.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        self._data = ({}, {}, {})
+        self._version = None
+        self._high_water = None
+        self._loaded_at = None
+
+    def _expired(self):
+        return (self._loaded_at is None
+                or time.monotonic() - self._loaded_at
+                > settings.RECIPE_INDEX_TTL)
+
+    def _refresh(self):
+        version = get_version('recipes')
+        if version == self._version and not self._expired():
+            return
+        with self._lock:
+            if self._expired():
+                self._load_all()
+            elif version != self._version:
+                self._load_changed()
+            self._version = version
+
+    def _load_all(self):
+        high_water = Recipe.objects.aggregate(
+            value=Max('updated_at'))['value']
+        recipes = defaultdict(set)
+        for recipe_id, ingredient_id in IngredientRecipe.objects.order_by(
+                ).values_list('recipe_id', 'ingredient_id').iterator():
+            recipes[recipe_id].add(ingredient_id)
+        postings = defaultdict(list)
+        for recipe_id in sorted(recipes):
+            for ingredient_id in recipes[recipe_id]:
+                postings[ingredient_id].append(recipe_id)
+        sizes = defaultdict(set)
+        for recipe_id, ingredients in recipes.items():
+            sizes[len(ingredients)].add(recipe_id)
+        self._data = (
+            {ingredient_id: array('q', recipe_ids)
+             for ingredient_id, recipe_ids in postings.items()},
+            {recipe_id: frozenset(ingredients)
+             for recipe_id, ingredients in recipes.items()},
+            {size: frozenset(recipe_ids)
+             for size, recipe_ids in sizes.items()})
+        self._high_water = high_water
+        self._loaded_at = time.monotonic()
+
+    def _load_changed(self):
+        changed = Recipe.objects.order_by()
+        if self._high_water is not None:
+            changed = changed.filter(
+                updated_at__gte=self._high_water - DELTA_OVERLAP)
+        changed = dict(changed.values_list('pk', 'updated_at'))
+        if not changed:
+            return
+        recipes = defaultdict(set)
+        for recipe_id, ingredient_id in IngredientRecipe.objects.filter(
+                recipe_id__in=list(changed)).order_by().values_list(
+                    'recipe_id', 'ingredient_id'):
+            recipes[recipe_id].add(ingredient_id)
+        # Новые структуры собираются рядом и подменяются одним
+        # присваиванием: match читает их без блокировки.
+        postings, old_recipes, sizes = self._data
+        new_recipes = dict(old_recipes)
+        removed, added = defaultdict(set), defaultdict(set)
+        sizes_removed, sizes_added = defaultdict(set), defaultdict(set)
+        for recipe_id in changed:
+            old = old_recipes.get(recipe_id, frozenset())
+            new = frozenset(recipes.get(recipe_id, ()))
+            for ingredient_id in old - new:
+                removed[ingredient_id].add(recipe_id)
+            for ingredient_id in new - old:
+                added[ingredient_id].add(recipe_id)
+            if old:
+                sizes_removed[len(old)].add(recipe_id)
+            if new:
+                sizes_added[len(new)].add(recipe_id)
+                new_recipes[recipe_id] = new
+            else:
+                new_recipes.pop(recipe_id, None)
+        self._data = (
+            patched(postings, removed, added,
+                    lambda recipe_ids: array('q', sorted(recipe_ids))),
+            new_recipes,
+            patched(sizes, sizes_removed, sizes_added, frozenset))
+        self._high_water = max(
+            filter(None, (self._high_water, *changed.values())))
+
+    def match(self, ingredient_ids, mode='all', missing=0):
+        """
+        Id рецептов по возрастанию, в которых есть все (all) или хотя бы
+        один (any) из ингредиентов, либо которым недостает не больше
+        missing ингредиентов (missing).
+        """
+        self._refresh()
+        index, recipes, sizes = self._data
+        postings = sorted(
+            (index.get(pk, EMPTY) for pk in set(ingredient_ids)), key=len)
+        if not postings:
+            return []
+        if mode == 'all':
+            first, rest = postings[0], postings[1:]
+            result = [
+                recipe_id for recipe_id in first
+                if all(contains(posting, recipe_id) for posting in rest)]
+        elif mode == 'any':
+            result = sorted(set(chain.from_iterable(postings)))
+        else:
+            counts = Counter(chain.from_iterable(postings))
+            # Рецепты без запрошенных ингредиентов подходят, если в них
+            # самих не больше missing ингредиентов.
+            for size, recipe_ids in sizes.items():
+                if size <= missing:
+                    counts.update(dict.fromkeys(recipe_ids, 0))
+            result = sorted(
+                recipe_id for recipe_id, count in counts.items()
+                if len(recipes.get(recipe_id, ())) - count <= missing)
+        return result
+
+
+recipe_index = RecipeIngredientIndex()
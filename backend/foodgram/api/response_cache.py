@@ -0,0 +1,70 @@
+import hashlib
+import threading
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.response import Response
+
+from .conditional import get_version, recipe_modified
+
+CACHED_PARAMS = ('tags', 'author', 'page', 'limit', 'cursor',
+                 'is_favorited', 'is_in_shopping_cart', 'search',
+                 'ingredients', 'match')
+KEY_PREFIX = 'recipes-response'
+
+
+class CacheStats:
+    """Счетчики попаданий и промахов кеша ответов в текущем процессе."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+stats = CacheStats()
+
+
+def response_cache_key(request, pk=None):
+    """
+    Ключ из версии рецептов и нормализованной строки запроса: известные
+    параметры отсортированы, остальные отброшены. Хост входит в ключ,
+    потому что ссылки на изображения и страницы абсолютные. Ключ рецепта
+    включает и его updated_at, уже прочитанный условным GET.
+    """
+    params = sorted(
+        (name, value)
+        for name in CACHED_PARAMS
+        for value in request.query_params.getlist(name))
+    modified = recipe_modified(request, pk) if pk is not None else None
+    raw = (f'{get_version("recipes")}|{modified}|'
+           f'{request.scheme}://{request.get_host()}{request.path}|{params}')
+    return f'{KEY_PREFIX}:{hashlib.md5(raw.encode()).hexdigest()}'
+
+
+def cache_anonymous(method):
+    """Кеширует данные ответа для анонимных пользователей."""
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        if not request.user.is_anonymous:
+            return method(self, request, *args, **kwargs)
+        key = response_cache_key(request, kwargs.get('pk'))
+        data = cache.get(key)
+        stats.record(hit=data is not None)
+        if data is not None:
+            response = Response(data)
+            response['X-Cache'] = 'HIT'
+            return response
+        response = method(self, request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, settings.RECIPES_CACHE_TIMEOUT)
+        response['X-Cache'] = 'MISS'
+        return response
+    return wrapper
@@ -1,16 +1,21 @@
-from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.db import transaction
 from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers
 
 from recipes.models import (Favorite, Ingredient, IngredientRecipe, Recipe,
-                            ShoppingCart, Tag)
+                            ShoppingCart, ShoppingListItem, Tag)
 from users.models import Subscribe, User
 
+from .images import schedule_image_processing, variant_url
+from .metrics import TimedSerializerMixin
+from .toggles import delete_rows
 from .validators import (validate_cooking_time, validate_ingredients,
                          validate_tags)
 
 
-class RecipeToRepresentationSerializer(serializers.ModelSerializer):
+class RecipeToRepresentationSerializer(TimedSerializerMixin,
+                                       serializers.ModelSerializer):
     """
     Вспомогательный сериализатор рецептов
     """
@@ -18,8 +23,14 @@ class RecipeToRepresentationSerializer(serializers.ModelSerializer):
         model = Recipe
         fields = ('id', 'name', 'image', 'cooking_time')
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data['image'] = variant_url(
+            self.context.get('request'), instance) or data['image']
+        return data
 
-class TagSerializer(serializers.ModelSerializer):
+
+class TagSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Сериализатор для использования с моделью Tag.
     """
@@ -28,7 +39,8 @@ class TagSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'color', 'slug')
 
 
-class FavoriteRecipeSerializer(serializers.ModelSerializer):
+class FavoriteRecipeSerializer(TimedSerializerMixin,
+                               serializers.ModelSerializer):
     """
     Сериализатор для работы с моделью Favorite.
     """
@@ -42,16 +54,8 @@ class FavoriteRecipeSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'image', 'cooking_time')
         read_only_fields = ('id', 'name', 'image', 'cooking_time')
 
-    def validate(self, data):
-        user = self.context.get('request').user
-        recipe = self.context.get('recipe')
-        if Favorite.objects.filter(recipe_fev=user, recipe=recipe).exists():
-            raise serializers.ValidationError({
-                'errors': 'Рецепт уже в избранном'})
-        return data
-
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Сериализатор для работы с моделью Ingredient.
     """
@@ -60,7 +64,7 @@ class IngredientSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'measurement_unit')
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Сериализатор для работы с моделью User.
     """
@@ -73,13 +77,15 @@ class UserSerializer(serializers.ModelSerializer):
                   'last_name', 'is_subscribed')
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         user = self.context['request'].user
         if user.is_anonymous:
             return False
         return user.follower.filter(author=obj).exists()
 
 
-class SubscribeSerializer(serializers.ModelSerializer):
+class SubscribeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Сериализатор для работы с моделью Subscribe.
     """
@@ -103,6 +109,9 @@ class SubscribeSerializer(serializers.ModelSerializer):
         return True
 
     def get_recipes(self, obj):
+        if hasattr(obj.author, 'recipes_preview'):
+            return RecipeToRepresentationSerializer(
+                obj.author.recipes_preview, many=True).data
         request = self.context.get('request')
         recipes = obj.author.recipe.all()
         recipes_limit = request.query_params.get('recipes_limit')
@@ -115,7 +124,7 @@ class SubscribeSerializer(serializers.ModelSerializer):
         return RecipeToRepresentationSerializer(recipes, many=True).data
 
     def get_recipes_count(self, obj):
-        return obj.author.recipe.count()
+        return obj.author.recipes_count
 
 
 class IngredientInRecipeSerializer(serializers.ModelSerializer):
@@ -137,7 +146,7 @@ class IngredientInRecipeSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'measurement_unit', 'amount')
 
 
-class RecipeSerializer(serializers.ModelSerializer):
+class RecipeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Сериализатор для работы с моделью Recipe.
     """
@@ -147,6 +156,7 @@ class RecipeSerializer(serializers.ModelSerializer):
     is_favorited = serializers.SerializerMethodField(read_only=True)
     is_in_shopping_cart = serializers.SerializerMethodField(read_only=True)
     image = Base64ImageField(use_url=True, max_length=None)
+    image_variants = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = Recipe
@@ -154,9 +164,27 @@ class RecipeSerializer(serializers.ModelSerializer):
             'id', 'tags', 'author',
             'ingredients', 'is_favorited',
             'is_in_shopping_cart', 'name',
-            'image', 'text', 'cooking_time')
+            'image', 'image_variants', 'text', 'cooking_time')
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        view = self.context.get('view')
+        if view is not None and view.action in ('list', 'feed'):
+            data['image'] = variant_url(
+                self.context.get('request'), instance) or data['image']
+        return data
+
+    def get_image_variants(self, obj):
+        request = self.context.get('request')
+        return {
+            variant: {
+                extension: variant_url(request, obj, variant, extension)
+                for extension in formats}
+            for variant, formats in obj.image_variants.items()}
 
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         request = self.context.get('request')
         if not request or request.user.is_anonymous:
             return False
@@ -164,6 +192,8 @@ class RecipeSerializer(serializers.ModelSerializer):
             recipe=obj, recipe_fev=request.user).exists()
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         request = self.context.get('request')
         if not request or request.user.is_anonymous:
             return False
@@ -171,8 +201,8 @@ class RecipeSerializer(serializers.ModelSerializer):
             recipe=obj, user=request.user).exists()
 
     def get_ingredients(self, obj):
-        queryset = IngredientRecipe.objects.filter(recipe=obj)
-        return IngredientInRecipeSerializer(queryset, many=True).data
+        return IngredientInRecipeSerializer(
+            obj.ingredients.all(), many=True).data
 
     def validate(self, data):
         tags = self.initial_data.get('tags')
@@ -185,8 +215,8 @@ class RecipeSerializer(serializers.ModelSerializer):
         if not ingredients:
             raise serializers.ValidationError({
                 'ingredients': 'Кажется вы забыли указать ингредиенты'})
-        validate_tags(tags, Tag)
-        validate_ingredients(ingredients, Ingredient)
+        tags = validate_tags(tags, Tag)
+        ingredients = validate_ingredients(ingredients, Ingredient)
         validate_cooking_time(cooking_time)
         data.update({
             'tags': tags,
@@ -195,6 +225,63 @@ class RecipeSerializer(serializers.ModelSerializer):
         })
         return data
 
+    @staticmethod
+    def add_ingredients(recipe, ingredients):
+        IngredientRecipe.objects.bulk_create(
+            IngredientRecipe(
+                recipe=recipe, ingredient_id=ingredient_id, amount=amount)
+            for ingredient_id, amount in ingredients)
+
+    @staticmethod
+    def add_tags(recipe, tags):
+        Recipe.tags.through.objects.bulk_create(
+            Recipe.tags.through(recipe=recipe, tag_id=tag_id)
+            for tag_id in tags)
+
+    def update_ingredients(self, recipe, ingredients):
+        """
+        Записывает только добавленные, измененные и удаленные строки и
+        одной дельтой правит списки покупок тех, у кого рецепт в корзине.
+        """
+        stored = {
+            row.ingredient_id: row
+            for row in IngredientRecipe.objects.filter(recipe=recipe).only(
+                'id', 'ingredient_id', 'amount')}
+        submitted = dict(ingredients)
+        deltas = {}
+        removed = stored.keys() - submitted.keys()
+        if removed:
+            # Без post_delete по строкам: их дельта входит в общую.
+            delete_rows(IngredientRecipe, [stored[pk].pk for pk in removed])
+            deltas.update({pk: -stored[pk].amount for pk in removed})
+        changed = []
+        for ingredient_id, amount in submitted.items():
+            row = stored.get(ingredient_id)
+            if row is None:
+                deltas[ingredient_id] = amount
+            elif row.amount != amount:
+                deltas[ingredient_id] = amount - row.amount
+                row.amount = amount
+                changed.append(row)
+        if changed:
+            IngredientRecipe.objects.bulk_update(changed, ['amount'])
+        self.add_ingredients(recipe, [
+            (ingredient_id, amount)
+            for ingredient_id, amount in ingredients
+            if ingredient_id not in stored])
+        ShoppingListItem.objects.apply_recipe_delta(recipe.pk, deltas)
+
+    def update_tags(self, recipe, tags):
+        through = Recipe.tags.through
+        stored = set(through.objects.filter(
+            recipe=recipe).values_list('tag_id', flat=True))
+        removed = stored - set(tags)
+        if removed:
+            through.objects.filter(
+                recipe=recipe, tag_id__in=removed).delete()
+        self.add_tags(recipe, [tag for tag in tags if tag not in stored])
+
+    @transaction.atomic
     def create(self, validated_data):
         tags = self.validated_data.pop('tags')
         ingredients = self.validated_data.pop('ingredients')
@@ -204,45 +291,39 @@ class RecipeSerializer(serializers.ModelSerializer):
             text=self.validated_data.pop('text'),
             cooking_time=self.validated_data.pop('cooking_time'),
             author=self.validated_data.pop('author'))
-        new_recipe.tags.add(*tags)
-        bulk_create_data = (
-            IngredientRecipe(
-                recipe=new_recipe,
-                ingredient=get_object_or_404(
-                    Ingredient, id=ingredient.get('id')),
-                amount=ingredient.get('amount'))
-            for ingredient in ingredients)
-        IngredientRecipe.objects.bulk_create(bulk_create_data)
+        self.add_tags(new_recipe, tags)
+        self.add_ingredients(new_recipe, ingredients)
+        new_recipe.update_search_document()
+        if new_recipe.image:
+            schedule_image_processing(new_recipe)
         return new_recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         new_tags = self.validated_data.pop('tags')
         new_ingredients = self.validated_data.pop('ingredients')
-
-        instance.image = validated_data.get('image', instance.image)
+        # Ингредиенты пишутся первыми: save собирает по ним поисковый текст.
+        self.update_ingredients(instance, new_ingredients)
+        self.update_tags(instance, new_tags)
+
+        stale_variants = None
+        if validated_data.get('image'):
+            instance.image = validated_data['image']
+            stale_variants = instance.image_variants
+            instance.image_variants = {}
         instance.name = validated_data.get('name', instance.name)
         instance.text = validated_data.get('text', instance.text)
         instance.cooking_time = validated_data.get(
             'cooking_time', instance.cooking_time)
         instance.save()
-
-        IngredientRecipe.objects.filter(recipe=instance).delete()
-        bulk_create_data = (
-            IngredientRecipe(
-                recipe=instance,
-                ingredient=get_object_or_404(
-                    Ingredient, id=ingredient.get('id')),
-                amount=ingredient.get('amount'))
-            for ingredient in new_ingredients)
-        IngredientRecipe.objects.bulk_create(bulk_create_data)
-
-        instance.tags.clear()
-        instance.tags.set(new_tags)
+        if stale_variants is not None:
+            schedule_image_processing(instance, stale_variants)
 
         return instance
 
 
-class ShoppingCartSerializer(serializers.ModelSerializer):
+class ShoppingCartSerializer(TimedSerializerMixin,
+                             serializers.ModelSerializer):
     """
     Сериалайзер для добавления и удаления рецепта из списка покупок.
     """
@@ -251,20 +332,31 @@ class ShoppingCartSerializer(serializers.ModelSerializer):
         fields = ('user', 'recipe')
         read_only_fields = ('user', 'recipe')
 
-    def validate(self, data):
-        user = self.context.get('request').user
-        recipe = self.context.get('recipe')
-        data['recipe'] = recipe
-        data['user'] = user
-        if ShoppingCart.objects.filter(user=user,
-                                       recipe=recipe).exists():
-            raise serializers.ValidationError({
-                'errors': 'Рецепт уже в списке покупок'})
-        return data
-
     def to_representation(self, instance):
         requset = self.context.get('request')
         return RecipeToRepresentationSerializer(
             instance.recipe,
             context={'request': requset}
         ).data
+
+
+class ShoppingListSerializer(TimedSerializerMixin, serializers.Serializer):
+    """
+    Строка списка покупок из shopping_list_queryset.
+    """
+    name = serializers.CharField(source='ingredient__name')
+    measurement_unit = serializers.CharField(
+        source='ingredient__measurement_unit')
+    amount = serializers.IntegerField()
+
+
+class BatchSerializer(serializers.Serializer):
+    """
+    Список id для пакетного добавления или удаления, без повторов.
+    """
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False,
+        max_length=settings.BATCH_MAX_SIZE)
+
+    def validate_ids(self, value):
+        return list(dict.fromkeys(value))
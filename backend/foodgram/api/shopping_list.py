@@ -0,0 +1,231 @@
+import csv
+import zlib
+from functools import lru_cache
+from itertools import chain
+
+from django.conf import settings
+from reportlab.pdfbase.ttfonts import SUBSETN, TTFontFace, makeToUnicodeCMap
+
+from recipes.models import ShoppingListItem
+
+TITLE = 'Список покупок:'
+
+
+def shopping_list_queryset(user):
+    """
+    Суммы ингредиентов из рецептов в корзине пользователя: готовые строки
+    ShoppingListItem, одно чтение по индексу (user, ingredient).
+    """
+    return ShoppingListItem.objects.filter(
+        user=user, amount__gt=0).values(
+            'ingredient__name', 'ingredient__measurement_unit',
+            'amount').order_by('ingredient__name')
+
+
+def shopping_list_rows(user):
+    """
+    Строки читаются с сервера по частям, а не загружаются целиком.
+    None, если список пуст.
+    """
+    rows = shopping_list_queryset(user).iterator()
+    first = next(rows, None)
+    if first is None:
+        return None
+    return chain((first,), rows)
+
+
+def format_row(row):
+    return (f'{row["ingredient__name"]}: '
+            f'{row["amount"]} '
+            f'{row["ingredient__measurement_unit"]}')
+
+
+def render_txt(rows):
+    yield f'{TITLE}\n\n'
+    for row in rows:
+        yield f'{format_row(row)}\n'
+
+
+class Echo:
+    """Псевдо-буфер: csv.writer возвращает строку вместо записи."""
+    def write(self, value):
+        return value
+
+
+def render_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('name', 'amount', 'measurement_unit'))
+    for row in rows:
+        yield writer.writerow((row['ingredient__name'], row['amount'],
+                               row['ingredient__measurement_unit']))
+
+
+def render_pdf(rows):
+    return StreamingPDF(get_font_face()).render([TITLE, ''], map(
+        format_row, rows))
+
+
+SHOPPING_LIST_FORMATS = {
+    'txt': (render_txt, 'text/plain', 'shopping_list.txt'),
+    'csv': (render_csv, 'text/csv', 'shopping_list.csv'),
+    'pdf': (render_pdf, 'application/pdf', 'shopping_list.pdf'),
+}
+
+
+@lru_cache(maxsize=None)
+def get_font_face():
+    return TTFontFace(settings.SHOPPING_LIST_FONT)
+
+
+class StreamingPDF:
+    """
+    Постраничная генерация PDF.
+
+    Каждая страница отдается клиенту сразу после заполнения; в памяти
+    остаются только смещения объектов и использованные символы шрифта.
+    Подмножества шрифта, дерево страниц и таблица xref дописываются
+    в конце документа.
+    """
+    PAGE_WIDTH = 595
+    PAGE_HEIGHT = 842
+    MARGIN = 50
+    FONT_SIZE = 11
+    LEADING = 16
+    CATALOG_ID = 1
+    PAGES_ID = 2
+    RESOURCES_ID = 3
+
+    def __init__(self, face):
+        self.face = face
+        self.offset = 0
+        self.offsets = {}
+        self.next_id = self.RESOURCES_ID + 1
+        self.page_ids = []
+        # Как и в reportlab, первые 128 кодов совпадают с ASCII.
+        self.subsets = [list(range(128))]
+        self.codes = {code: (0, code) for code in range(128)}
+
+    def lines_per_page(self):
+        return (self.PAGE_HEIGHT - 2 * self.MARGIN) // self.LEADING
+
+    def allocate(self):
+        object_id = self.next_id
+        self.next_id += 1
+        return object_id
+
+    def write_object(self, object_id, body):
+        self.offsets[object_id] = self.offset
+        return self.write(b'%d 0 obj\n' % object_id + body + b'\nendobj\n')
+
+    def write_stream(self, object_id, content, **extra):
+        content = zlib.compress(content)
+        entries = ''.join(f' /{key} {value}' for key, value in extra.items())
+        return self.write_object(object_id, (
+            f'<< /Length {len(content)} /Filter /FlateDecode{entries} >>\n'
+            'stream\n').encode() + content + b'\nendstream')
+
+    def write(self, data):
+        self.offset += len(data)
+        return data
+
+    def encode(self, text):
+        """Разбивает строку на отрезки (номер подмножества, байты)."""
+        runs = []
+        for char in text:
+            code = ord(char)
+            if code not in self.codes:
+                if len(self.subsets[-1]) == 256:
+                    self.subsets.append([])
+                self.codes[code] = (
+                    len(self.subsets) - 1, len(self.subsets[-1]))
+                self.subsets[-1].append(code)
+            subset, byte = self.codes[code]
+            if runs and runs[-1][0] == subset:
+                runs[-1][1].append(byte)
+            else:
+                runs.append((subset, bytearray((byte,))))
+        return runs
+
+    def write_page(self, lines):
+        commands = [
+            'BT',
+            f'{self.LEADING} TL',
+            f'{self.MARGIN} {self.PAGE_HEIGHT - self.MARGIN} Td']
+        for line in lines:
+            for subset, data in self.encode(line):
+                commands.append(
+                    f'/F{subset} {self.FONT_SIZE} Tf <{data.hex()}> Tj')
+            commands.append('T*')
+        commands.append('ET')
+        content_id, page_id = self.allocate(), self.allocate()
+        self.page_ids.append(page_id)
+        return self.write_stream(
+            content_id, '\n'.join(commands).encode()) + self.write_object(
+            page_id, (
+                f'<< /Type /Page /Parent {self.PAGES_ID} 0 R '
+                f'/MediaBox [0 0 {self.PAGE_WIDTH} {self.PAGE_HEIGHT}] '
+                f'/Resources {self.RESOURCES_ID} 0 R '
+                f'/Contents {content_id} 0 R >>').encode())
+
+    def write_font(self, number, subset):
+        face = self.face
+        name = (SUBSETN(number) + b'+' + face.name).decode('latin-1')
+        font_id, descriptor_id, file_id, cmap_id = (
+            self.allocate() for _ in range(4))
+        widths = ' '.join(str(face.getCharWidth(code)) for code in subset)
+        bbox = ' '.join(str(value) for value in face.bbox)
+        font_file = face.makeSubset(subset)
+        return b''.join((
+            self.write_object(font_id, (
+                f'<< /Type /Font /Subtype /TrueType /BaseFont /{name} '
+                f'/FirstChar 0 /LastChar {len(subset) - 1} '
+                f'/Widths [{widths}] /FontDescriptor {descriptor_id} 0 R '
+                f'/ToUnicode {cmap_id} 0 R >>').encode()),
+            self.write_object(descriptor_id, (
+                f'<< /Type /FontDescriptor /FontName /{name} '
+                f'/Flags 4 /FontBBox [{bbox}] /ItalicAngle '
+                f'{face.italicAngle} /Ascent {face.ascent} '
+                f'/Descent {face.descent} /CapHeight {face.capHeight} '
+                f'/StemV {face.stemV} /FontFile2 {file_id} 0 R >>').encode()),
+            self.write_stream(file_id, font_file, Length1=len(font_file)),
+            self.write_stream(
+                cmap_id, makeToUnicodeCMap(name, subset).encode()),
+        )), font_id
+
+    def write_trailer(self):
+        chunks, fonts = [], []
+        for number, subset in enumerate(self.subsets):
+            chunk, font_id = self.write_font(number, subset)
+            chunks.append(chunk)
+            fonts.append(f'/F{number} {font_id} 0 R')
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self.page_ids)
+        chunks.append(self.write_object(self.RESOURCES_ID, (
+            f'<< /Font << {" ".join(fonts)} >> >>').encode()))
+        chunks.append(self.write_object(self.PAGES_ID, (
+            f'<< /Type /Pages /Kids [{kids}] '
+            f'/Count {len(self.page_ids)} >>').encode()))
+        xref_offset = self.offset
+        xref = [f'xref\n0 {self.next_id}\n', '0000000000 65535 f \n']
+        xref.extend(
+            f'{self.offsets[object_id]:010d} 00000 n \n'
+            for object_id in range(1, self.next_id))
+        xref.append(
+            f'trailer\n<< /Size {self.next_id} '
+            f'/Root {self.CATALOG_ID} 0 R >>\n'
+            f'startxref\n{xref_offset}\n%%EOF\n')
+        chunks.append(self.write(''.join(xref).encode()))
+        return b''.join(chunks)
+
+    def render(self, header, lines):
+        yield self.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        yield self.write_object(self.CATALOG_ID, (
+            f'<< /Type /Catalog /Pages {self.PAGES_ID} 0 R >>').encode())
+        page = list(header)
+        for line in lines:
+            page.append(line)
+            if len(page) == self.lines_per_page():
+                yield self.write_page(page)
+                page = []
+        if page or not self.page_ids:
+            yield self.write_page(page)
+        yield self.write_trailer()
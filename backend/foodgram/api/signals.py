@@ -0,0 +1,64 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from recipes.models import Ingredient, IngredientRecipe, Recipe, Tag
+from users.models import User
+
+from .authentication import token_cache
+from .conditional import bump_version
+from .ingredient_index import ingredient_index
+from .metrics import record_query
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def ingredient_changed(**kwargs):
+    # Как и версии, индекс сбрасывается после коммита: иначе чтение до
+    # коммита загрузит в него старые строки.
+    transaction.on_commit(ingredient_index.invalidate)
+    bump_version('ingredients', 'recipes')
+
+
+@receiver((post_save, post_delete), sender=Tag)
+def tag_changed(**kwargs):
+    bump_version('tags', 'recipes')
+
+
+@receiver((post_save, post_delete), sender=Recipe)
+@receiver((post_save, post_delete), sender=IngredientRecipe)
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def recipe_changed(**kwargs):
+    bump_version('recipes')
+
+
+def is_login(update_fields):
+    # Вход пользователя обновляет только last_login.
+    return update_fields is not None and set(update_fields) == {'last_login'}
+
+
+@receiver(post_save, sender=User)
+def author_changed(update_fields=None, **kwargs):
+    if not is_login(update_fields):
+        bump_version('recipes')
+
+
+@receiver(post_save, sender=User)
+def user_changed(instance, update_fields=None, **kwargs):
+    # Блокировка и правка профиля не должны ждать истечения кеша.
+    if not is_login(update_fields):
+        token_cache.invalidate(*Token.objects.filter(
+            user=instance).values_list('key', flat=True))
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+
+@receiver(connection_created)
+def connection_opened(connection, **kwargs):
+    # Обертка остается на соединении и после переподключения.
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
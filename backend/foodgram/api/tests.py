@@ -1,3 +1,1514 @@
-from django.test import TestCase
+import base64
+import json
+import re
+import time
+from contextlib import contextmanager
+from io import BytesIO, StringIO
+from tempfile import TemporaryDirectory
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import Q, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api.authentication import token_cache
+from api.filters import tag_ids_by_slug
+from api.images import IMAGE_VARIANTS
+from api.ingredient_index import ingredient_index
+from api.metrics import RequestMetrics, registry
+from api.query_plans import canonical_queries, plan_issues
+from api.recipe_index import recipe_index
+from api.response_cache import stats as cache_stats
+from api.toggles import add_link, remove_link
+from recipes.models import (Favorite, Ingredient, IngredientRecipe, Recipe,
+                            ShoppingCart, ShoppingListItem, Tag,
+                            TimelineEntry)
+from users.models import Subscribe, User
+
+USERS_COUNT = 30
+RECIPES_PER_AUTHOR = 4
+INGREDIENTS_COUNT = 60
+INGREDIENTS_PER_RECIPE = 5
+PAGE_SIZES = (1, 6, 50)
+# Прозрачный PNG 1x1 для полей изображений.
+IMAGE = ('data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAf'
+         'FcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+# Бюджет по времени на один запрос, с запасом для медленных CI.
+LATENCY_BUDGET = 0.5
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Базовый класс: реалистичные данные и проверка бюджета запросов.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        # bulk_create не на всех СУБД возвращает pk, поэтому объекты
+        # перечитываются из базы.
+        User.objects.bulk_create(
+            User(email=f'user{i}@foodgram.ru', username=f'user{i}',
+                 first_name=f'Имя{i}', last_name=f'Фамилия{i}')
+            for i in range(USERS_COUNT))
+        cls.users = list(User.objects.order_by('pk'))
+        cls.user = cls.users[0]
+        Tag.objects.bulk_create(
+            Tag(name=name, color=color, slug=slug)
+            for name, color, slug in (
+                ('Завтрак', '#ffffff', 'breakfast'),
+                ('Обед', '#009900', 'lunch'),
+                ('Ужин', '#ff0000', 'dinner')))
+        cls.tags = list(Tag.objects.order_by('pk'))
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент{i}', measurement_unit='г')
+            for i in range(INGREDIENTS_COUNT))
+        cls.ingredients = list(Ingredient.objects.order_by('pk'))
+        Recipe.objects.bulk_create(
+            Recipe(author=author, name=f'Рецепт{author.pk}x{i}',
+                   text='Описание', cooking_time=10)
+            for author in cls.users for i in range(RECIPES_PER_AUTHOR))
+        cls.recipes = list(Recipe.objects.order_by('pk'))
+        Recipe.tags.through.objects.bulk_create(
+            Recipe.tags.through(recipe=recipe, tag=tag)
+            for recipe in cls.recipes for tag in cls.tags[:2])
+        IngredientRecipe.objects.bulk_create(
+            IngredientRecipe(
+                recipe=recipe,
+                ingredient=cls.ingredients[(n + i) % INGREDIENTS_COUNT],
+                amount=i + 1)
+            for n, recipe in enumerate(cls.recipes)
+            for i in range(INGREDIENTS_PER_RECIPE))
+        Favorite.objects.bulk_create(
+            Favorite(recipe=recipe, recipe_fev=user)
+            for user in cls.users[:5] for recipe in cls.recipes[::3])
+        ShoppingCart.objects.bulk_create(
+            ShoppingCart(recipe=recipe, user=user)
+            for user in cls.users[:5] for recipe in cls.recipes[::7])
+        Subscribe.objects.bulk_create(
+            Subscribe(user=user, author=author)
+            for user in cls.users[:5] for author in cls.users[5:])
+        cls.free_recipe = Recipe.objects.create(
+            author=cls.users[-1], name='Свободный', text='Описание',
+            cooking_time=5)
+        cls.free_author = User.objects.create(
+            email='free@foodgram.ru', username='free',
+            first_name='Имя', last_name='Фамилия')
+        # bulk_create не отправляет сигналы, счетчики и списки покупок
+        # пересчитываются.
+        call_command('recount_counters', stdout=StringIO())
+        call_command('rebuild_shopping_lists', stdout=StringIO())
+        call_command('rebuild_timelines', stdout=StringIO())
+
+    def setUp(self):
+        # Откат транзакции теста не отправляет сигналы, сбрасываем индекс
+        # и кеш.
+        ingredient_index.invalidate()
+        recipe_index.invalidate()
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @contextmanager
+    def assertBudget(self, max_queries, latency=LATENCY_BUDGET):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            yield
+            elapsed = time.perf_counter() - start
+        self.assertLessEqual(
+            len(context), max_queries,
+            '\n'.join(query['sql'] for query in context.captured_queries))
+        self.assertLess(elapsed, latency)
+
+    def assertListBudget(self, url, max_queries, anonymous=False):
+        if anonymous:
+            self.client.force_authenticate(None)
+        separator = '&' if '?' in url else '?'
+        for limit in PAGE_SIZES:
+            with self.subTest(limit=limit, anonymous=anonymous):
+                with self.assertBudget(max_queries):
+                    response = self.client.get(
+                        f'{url}{separator}limit={limit}')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class RecipeBudgetTest(QueryBudgetTestCase):
+    def test_recipe_list(self):
+        self.assertListBudget('/api/recipes/', 5)
+        self.assertListBudget('/api/recipes/', 5, anonymous=True)
+
+    def test_recipe_list_filtered(self):
+        # Карта тегов строится один раз и дальше берется из кеша.
+        tag_ids_by_slug()
+        self.assertListBudget(
+            '/api/recipes/?tags=breakfast&is_favorited=1', 5)
+        # Фильтр автора проверяет id, читая пользователя.
+        self.assertListBudget(
+            f'/api/recipes/?author={self.users[3].pk}'
+            '&is_in_shopping_cart=1', 6)
+
+    def test_tags_filter(self):
+        with self.assertBudget(6):
+            response = self.client.get(
+                '/api/recipes/?limit=50&tags=breakfast&tags=lunch')
+        ids = [recipe['id'] for recipe in response.data['results']]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(response.data['count'], len(self.recipes))
+
+        response = self.client.get('/api/recipes/?tags=brunch')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name='Бранч', color='#000000', slug='brunch')
+        response = self.client.get('/api/recipes/?tags=brunch')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 0)
+
+    def test_recipe_detail(self):
+        with self.assertBudget(5):
+            response = self.client.get(f'/api/recipes/{self.recipes[0].pk}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            len(response.data['ingredients']), INGREDIENTS_PER_RECIPE)
+
+
+class KeysetPaginationTest(QueryBudgetTestCase):
+    def walk(self, url, max_queries):
+        ids = []
+        while url:
+            with self.assertBudget(max_queries):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            ids.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def test_recipes_cursor(self):
+        # Без COUNT: страница, автор, теги и ингредиенты.
+        ids = self.walk('/api/recipes/?cursor=&limit=7', 4)
+        self.assertEqual(ids, list(
+            Recipe.objects.order_by('-pub_date', '-id').values_list(
+                'id', flat=True)))
+
+    def test_recipes_cursor_filtered(self):
+        tag_ids_by_slug()
+        ids = self.walk(
+            '/api/recipes/?cursor=&limit=5&tags=breakfast&is_favorited=1', 4)
+        self.assertEqual(ids, list(
+            Recipe.objects.filter(
+                favorite__recipe_fev=self.user, tags__slug='breakfast'
+            ).order_by('-pub_date', '-id').values_list('id', flat=True)))
+
+    def test_subscriptions_cursor(self):
+        response = self.client.get(
+            '/api/users/subscriptions/?cursor=&limit=10')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertIsNotNone(response.data['next'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/recipes/?cursor=bm9wZQ')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ToggleBudgetTest(QueryBudgetTestCase):
+    def test_favorite_toggle(self):
+        url = f'/api/recipes/{self.free_recipe.pk}/favorite/'
+        with self.assertBudget(4):
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['id'], self.free_recipe.pk)
+        with self.assertBudget(3):
+            response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_shopping_cart_toggle(self):
+        # Плюс чтение ингредиентов рецепта для списка покупок.
+        url = f'/api/recipes/{self.free_recipe.pk}/shopping_cart/'
+        with self.assertBudget(5):
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['id'], self.free_recipe.pk)
+        with self.assertBudget(4):
+            response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_subscribe_toggle(self):
+        # Плюс заполнение ленты рецептами автора и ее чистка.
+        url = f'/api/users/{self.free_author.pk}/subscribe/'
+        with self.assertBudget(6):
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with self.assertBudget(4):
+            response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_link_instances(self):
+        # Обработчики post_save получают объект с pk вставленной строки.
+        for recipe, returning in ((self.free_recipe, True),
+                                  (self.recipes[1], False)):
+            with self.subTest(returning=returning), mock.patch(
+                    'api.toggles.can_return_rows', return_value=returning):
+                favorite = add_link(
+                    Favorite, recipe=recipe, recipe_fev=self.user)
+                self.assertFalse(favorite._state.adding)
+                self.assertEqual(favorite, Favorite.objects.get(
+                    recipe=recipe, recipe_fev=self.user))
+                self.assertIsNone(add_link(
+                    Favorite, recipe=recipe, recipe_fev=self.user))
+                self.assertTrue(remove_link(
+                    Favorite, recipe=recipe, recipe_fev=self.user))
+                self.assertFalse(remove_link(
+                    Favorite, recipe=recipe, recipe_fev=self.user))
+
+    def test_concurrent_remove(self):
+        # Строку удаляет другой запрос между чтением и DELETE этого:
+        # обработчики post_delete срабатывают только у победителя.
+        flour = self.ingredients[0]
+        Recipe.objects.bulk_create(
+            Recipe(author=self.free_author, name=f'Пирог{i}',
+                   text='Описание', cooking_time=5) for i in range(2))
+        first, second = Recipe.objects.filter(
+            name__startswith='Пирог').order_by('pk')
+        IngredientRecipe.objects.bulk_create(
+            IngredientRecipe(recipe=recipe, ingredient=flour, amount=100)
+            for recipe in (first, second))
+        for recipe in (first, second):
+            add_link(ShoppingCart, recipe=recipe, user=self.free_author)
+        deleted = []
+
+        def concurrent_delete(execute, sql, params, many, context):
+            if sql.startswith('DELETE') and not deleted:
+                deleted.append(sql)
+                ShoppingCart.objects.filter(
+                    recipe=first, user=self.free_author).delete()
+            return execute(sql, params, many, context)
+
+        for returning in (True, False):
+            with self.subTest(returning=returning), mock.patch(
+                    'api.toggles.can_return_rows', return_value=returning):
+                deleted.clear()
+                if not ShoppingCart.objects.filter(
+                        recipe=first, user=self.free_author).exists():
+                    add_link(ShoppingCart, recipe=first,
+                             user=self.free_author)
+                with connection.execute_wrapper(concurrent_delete):
+                    self.assertFalse(remove_link(
+                        ShoppingCart, recipe=first, user=self.free_author))
+                self.assertTrue(deleted)
+                first.refresh_from_db()
+                self.assertEqual(first.shopping_carts_count, 0)
+                self.assertEqual(ShoppingListItem.objects.get(
+                    user=self.free_author, ingredient=flour).amount, 100)
+
+    def test_repeated_toggles(self):
+        # Повторное нажатие упирается в уникальность, а не в IntegrityError.
+        recipe = self.free_recipe
+        for url in (f'/api/recipes/{recipe.pk}/favorite/',
+                    f'/api/recipes/{recipe.pk}/shopping_cart/',
+                    f'/api/users/{self.free_author.pk}/subscribe/'):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.post(url).status_code,
+                                 status.HTTP_201_CREATED)
+                with self.assertBudget(2):
+                    response = self.client.post(url)
+                self.assertEqual(response.status_code,
+                                 status.HTTP_400_BAD_REQUEST)
+                self.assertIn('errors', response.json())
+                self.assertEqual(self.client.delete(url).status_code,
+                                 status.HTTP_204_NO_CONTENT)
+                with self.assertBudget(2):
+                    response = self.client.delete(url)
+                self.assertEqual(response.status_code,
+                                 status.HTTP_400_BAD_REQUEST)
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 0)
+        self.assertEqual(recipe.shopping_carts_count, 0)
+        self.free_author.refresh_from_db()
+        self.assertEqual(self.free_author.followers_count, 0)
+
+    def test_missing_targets(self):
+        self.assertEqual(
+            self.client.post('/api/recipes/999999/favorite/').status_code,
+            status.HTTP_404_NOT_FOUND)
+        self.assertEqual(
+            self.client.delete('/api/users/999999/subscribe/').status_code,
+            status.HTTP_404_NOT_FOUND)
+        self.assertEqual(
+            self.client.post(
+                f'/api/users/{self.user.pk}/subscribe/').status_code,
+            status.HTTP_400_BAD_REQUEST)
+
+
+class BatchToggleTest(QueryBudgetTestCase):
+    def assertResults(self, response, expected):
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            {item['id']: item['status'] for item in response.json()[
+                'results']}, expected)
+
+    def test_favorite_batch(self):
+        url = '/api/recipes/favorite/batch/'
+        new, old = self.free_recipe, self.recipes[0]
+        ids = [new.pk, old.pk, new.pk, 10 ** 6]
+        with self.assertBudget(6):
+            response = self.client.post(url, {'ids': ids}, format='json')
+        self.assertResults(response, {
+            new.pk: 'created', old.pk: 'exists', 10 ** 6: 'not_found'})
+        new.refresh_from_db()
+        self.assertEqual(new.favorites_count, 1)
+        self.assertTrue(Favorite.objects.filter(
+            recipe=new, recipe_fev=self.user).exists())
+
+        old.refresh_from_db()
+        old_count = old.favorites_count
+        with self.assertBudget(6):
+            response = self.client.delete(url, {'ids': ids}, format='json')
+        self.assertResults(response, {
+            new.pk: 'deleted', old.pk: 'deleted', 10 ** 6: 'absent'})
+        old.refresh_from_db()
+        new.refresh_from_db()
+        self.assertEqual(new.favorites_count, 0)
+        self.assertEqual(old.favorites_count, old_count - 1)
+        self.assertFalse(Favorite.objects.filter(
+            recipe__in=(new, old), recipe_fev=self.user).exists())
+
+    def test_shopping_cart_batch(self):
+        url = '/api/recipes/shopping_cart/batch/'
+        recipes = [self.free_recipe, *self.recipes[1:4]]
+        ids = [recipe.pk for recipe in recipes]
+        lists_modified = self.user.lists_modified
+        response = self.client.post(url, {'ids': ids}, format='json')
+        self.assertResults(response, dict.fromkeys(ids, 'created'))
+        self.assertEqual(ShoppingCart.objects.filter(
+            user=self.user, recipe__in=ids).count(), len(ids))
+        self.user.refresh_from_db()
+        self.assertNotEqual(self.user.lists_modified, lists_modified)
+        response = self.client.delete(url, {'ids': ids}, format='json')
+        self.assertResults(response, dict.fromkeys(ids, 'deleted'))
+        for recipe in recipes:
+            self.assertEqual(
+                Recipe.objects.get(pk=recipe.pk).shopping_carts_count,
+                recipe.shopping_carts_count)
+
+    def test_subscribe_batch(self):
+        url = '/api/users/subscribe/batch/'
+        author = self.free_author
+        response = self.client.post(
+            url, {'ids': [author.pk, self.user.pk, self.users[5].pk]},
+            format='json')
+        self.assertResults(response, {
+            author.pk: 'created', self.user.pk: 'self',
+            self.users[5].pk: 'exists'})
+        author.refresh_from_db()
+        self.assertEqual(author.followers_count, 1)
+        response = self.client.delete(
+            url, {'ids': [author.pk]}, format='json')
+        self.assertResults(response, {author.pk: 'deleted'})
+        author.refresh_from_db()
+        self.assertEqual(author.followers_count, 0)
+
+    def test_concurrent_single_toggle(self):
+        # Одиночный запрос добавляет рецепт в корзину между проверкой
+        # и вставкой пакета: счетчик и список покупок меняются один раз.
+        def toggle_meanwhile(user, pk):
+            ShoppingCart.objects.create(recipe_id=pk, user=user)
+
+        # Вставка с RETURNING и построчная для СУБД без него.
+        for recipe, returning in ((self.free_recipe, True),
+                                  (self.recipes[1], False)):
+            with self.subTest(returning=returning), mock.patch(
+                    'api.mixins.BatchToggleView.reject',
+                    side_effect=toggle_meanwhile), mock.patch(
+                        'api.toggles.can_return_rows',
+                        return_value=returning):
+                response = self.client.post(
+                    '/api/recipes/shopping_cart/batch/',
+                    {'ids': [recipe.pk]}, format='json')
+                self.assertResults(response, {recipe.pk: 'exists'})
+                count = recipe.shopping_carts_count
+                recipe.refresh_from_db()
+                self.assertEqual(recipe.shopping_carts_count, count + 1)
+        call_command('rebuild_shopping_lists', '--check', stdout=StringIO())
+
+    def test_invalid_ids(self):
+        url = '/api/recipes/favorite/batch/'
+        for payload in ({}, {'ids': []}, {'ids': ['x']}, {'ids': [0]},
+                        {'ids': list(range(1, 102))}):
+            with self.subTest(payload=payload):
+                response = self.client.post(url, payload, format='json')
+                self.assertEqual(response.status_code,
+                                 status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(None)
+        response = self.client.post(url, {'ids': [1]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class RecipeWriteTestCase(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        media = TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+
+    def payload(self, ingredients, tags=None):
+        return {
+            'name': 'Большой', 'text': 'Описание', 'cooking_time': 30,
+            'image': IMAGE,
+            'tags': tags or [tag.pk for tag in self.tags],
+            'ingredients': [
+                {'id': ingredient.pk, 'amount': n + 1}
+                for n, ingredient in enumerate(ingredients)]}
+
+
+class RecipeWriteBudgetTest(RecipeWriteTestCase):
+    def test_create_and_update(self):
+        # Проверки id, запись рецепта, строк ингредиентов, тегов и
+        # поискового текста не зависят от числа ингредиентов.
+        with self.assertBudget(14):
+            response = self.client.post(
+                '/api/recipes/', self.payload(self.ingredients[:30]),
+                format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        recipe = Recipe.objects.get(pk=response.data['id'])
+        self.assertEqual(recipe.ingredients.count(), 30)
+        self.assertEqual(recipe.tags.count(), len(self.tags))
+
+        # Разница считается по двум чтениям, затем удаление, обновление
+        # и вставка пакетами; save читает имена для поискового текста,
+        # теги и ингредиенты ответа подгружаются один раз после записи.
+        with self.assertBudget(17):
+            response = self.client.patch(
+                f'/api/recipes/{recipe.pk}/',
+                self.payload(self.ingredients[20:50], [self.tags[0].pk]),
+                format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('n1;', response['Server-Timing'])
+        self.assertEqual(
+            [item['id'] for item in response.data['tags']], [self.tags[0].pk])
+        self.assertEqual(len(response.data['ingredients']), 30)
+        self.assertEqual(
+            set(recipe.ingredients.values_list('ingredient', 'amount')),
+            {(ingredient.pk, n + 1)
+             for n, ingredient in enumerate(self.ingredients[20:50])})
+        self.assertEqual(list(recipe.tags.all()), [self.tags[0]])
+
+    def create_recipe(self, ingredients):
+        response = self.client.post(
+            '/api/recipes/', self.payload(ingredients), format='json')
+        return Recipe.objects.get(pk=response.data['id'])
+
+    def test_unchanged_relations_not_written(self):
+        recipe = self.create_recipe(self.ingredients[:10])
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(
+                f'/api/recipes/{recipe.pk}/',
+                self.payload(self.ingredients[:10]), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        writes = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))
+            and ('recipes_ingredientrecipe' in query['sql']
+                 or 'recipes_recipe_tags' in query['sql'])]
+        self.assertEqual(writes, [])
+
+    def test_update_applies_diff(self):
+        recipe = self.create_recipe(self.ingredients[:4])
+        kept = dict(recipe.ingredients.values_list('ingredient', 'pk'))
+        payload = self.payload(self.ingredients[1:6], [self.tags[2].pk])
+        payload['ingredients'][0]['amount'] = 100
+        response = self.client.patch(
+            f'/api/recipes/{recipe.pk}/', payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = {
+            ingredient: (pk, amount)
+            for ingredient, pk, amount in recipe.ingredients.values_list(
+                'ingredient', 'pk', 'amount')}
+        self.assertEqual(
+            {ingredient: amount for ingredient, (_, amount) in rows.items()},
+            {item['id']: item['amount'] for item in payload['ingredients']})
+        for ingredient in self.ingredients[1:4]:
+            self.assertEqual(rows[ingredient.pk][0], kept[ingredient.pk])
+        self.assertEqual(list(recipe.tags.all()), [self.tags[2]])
+
+    def test_invalid_ingredients(self):
+        known = self.ingredients[0].pk
+        for ingredients in (
+                [{'id': known, 'amount': 1}, {'id': str(known), 'amount': 2}],
+                [{'id': 10 ** 6, 'amount': 1}],
+                [{'id': known, 'amount': 0}],
+                [{'id': 'x', 'amount': 1}]):
+            with self.subTest(ingredients=ingredients):
+                payload = self.payload([])
+                payload['ingredients'] = ingredients
+                with self.assertBudget(3):
+                    response = self.client.post(
+                        '/api/recipes/', payload, format='json')
+                self.assertEqual(
+                    response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_unknown_tag(self):
+        response = self.client.post(
+            '/api/recipes/', self.payload(self.ingredients[:1], [10 ** 6]),
+            format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(IMAGE_WORKERS=0)
+class RecipeImageTest(RecipeWriteTestCase):
+    def photo(self, color):
+        buffer = BytesIO()
+        Image.new('RGB', (2000, 1000), color).save(buffer, 'PNG')
+        return ('data:image/png;base64,'
+                + base64.b64encode(buffer.getvalue()).decode())
+
+    def save(self, method, url, color):
+        payload = self.payload(self.ingredients[:2])
+        payload['image'] = self.photo(color)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = getattr(self.client, method)(
+                url, payload, format='json')
+        self.assertIn(response.status_code, (200, 201))
+        return Recipe.objects.get(pk=response.data['id'])
+
+    def test_variants_generated_and_listed(self):
+        recipe = self.save('post', '/api/recipes/', 'red')
+        self.assertEqual(set(recipe.image_variants), set(IMAGE_VARIANTS))
+        for variant, size in IMAGE_VARIANTS.items():
+            for name in recipe.image_variants[variant].values():
+                with default_storage.open(name) as file:
+                    self.assertEqual(Image.open(file).size, (size, size // 2))
+
+        results = self.client.get('/api/recipes/?limit=1').data['results']
+        self.assertTrue(results[0]['image'].endswith('-thumbnail.jpeg'))
+        detail = self.client.get(f'/api/recipes/{recipe.pk}/').data
+        self.assertEqual(
+            detail['image'], f'http://testserver{recipe.image.url}')
+        self.assertTrue(
+            detail['image_variants']['card']['webp'].endswith('-card.webp'))
+
+    def test_new_photo_replaces_variants(self):
+        recipe = self.save('post', '/api/recipes/', 'red')
+        stale = recipe.image_variants
+        recipe = self.save('patch', f'/api/recipes/{recipe.pk}/', 'blue')
+        self.assertNotEqual(recipe.image_variants, stale)
+        for name in stale['thumbnail'].values():
+            self.assertFalse(default_storage.exists(name))
+
+
+class RecipeSearchTest(QueryBudgetTestCase):
+    def create_recipe(self, name, text, ingredients):
+        recipe = Recipe.objects.create(
+            author=self.free_author, name=name, text=text, cooking_time=5)
+        IngredientRecipe.objects.bulk_create(
+            IngredientRecipe(recipe=recipe, ingredient=ingredient, amount=1)
+            for ingredient in ingredients)
+        recipe.update_search_document()
+        return recipe
+
+    def search(self, query, max_queries=5):
+        with self.assertBudget(max_queries):
+            response = self.client.get(f'/api/recipes/?search={query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_ranked_by_relevance(self):
+        beet = Ingredient.objects.create(name='свекла', measurement_unit='г')
+        soup = self.create_recipe('Борщ', 'Суп суп из свеклы', [beet])
+        porridge = self.create_recipe('Каша', 'Не суп', self.ingredients[:1])
+        salad = self.create_recipe('Салат', 'Нарезать', [beet])
+        self.assertEqual(self.search('суп'), [soup.pk, porridge.pk])
+        self.assertEqual(self.search('свекл'), [soup.pk, salad.pk])
+        self.assertEqual(self.search('СУП борщ'), [soup.pk])
+        self.assertEqual(self.search('!!!'), [])
+
+    def test_follows_writes(self):
+        meat = Ingredient.objects.create(name='мясо', measurement_unit='г')
+        recipe = self.create_recipe('Плов', 'Рис', [meat])
+        meat.name = 'баранина'
+        meat.save()
+        self.assertEqual(self.search('баранина'), [recipe.pk])
+        recipe.name = 'Пилав'
+        recipe.save()
+        self.assertEqual(self.search('плов'), [])
+        self.assertEqual(self.search('пилав'), [recipe.pk])
+        recipe.delete()
+        self.assertEqual(self.search('пилав'), [])
+
+    def test_rebuild_command(self):
+        self.assertEqual(self.search(self.recipes[0].name), [])
+        call_command('rebuild_search', batch_size=7, stdout=StringIO())
+        self.assertEqual(
+            self.search(self.recipes[0].name), [self.recipes[0].pk])
+
+
+class IngredientMatchTest(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.x, self.y, self.z = (
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('икс', 'игрек', 'зет'))
+        self.a = self.create_recipe('А', (self.x, self.y))
+        self.b = self.create_recipe('Б', (self.x, self.y, self.z))
+        self.c = self.create_recipe('В', (self.z,))
+
+    def create_recipe(self, name, ingredients):
+        recipe = Recipe.objects.create(
+            author=self.free_author, name=name, text='Описание',
+            cooking_time=5)
+        IngredientRecipe.objects.bulk_create(
+            IngredientRecipe(recipe=recipe, ingredient=ingredient, amount=1)
+            for ingredient in ingredients)
+        return recipe
+
+    def match(self, ingredients, match=None, max_queries=5):
+        url = ('/api/recipes/?limit=50&ingredients='
+               + ','.join(str(ingredient.pk) for ingredient in ingredients))
+        if match:
+            url += f'&match={match}'
+        with self.assertBudget(max_queries):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {recipe['id'] for recipe in response.data['results']}
+
+    def test_modes(self):
+        x, y, z = self.x, self.y, self.z
+        self.assertEqual(
+            self.match((x, y), max_queries=7), {self.a.pk, self.b.pk})
+        self.assertEqual(self.match((x, z), 'all'), {self.b.pk})
+        self.assertEqual(self.match((x, z), 'any'),
+                         {self.a.pk, self.b.pk, self.c.pk})
+        # В рецепте В нет ни одного из запрошенных, но недостает одного.
+        self.assertEqual(self.match((x, y), 'missing<=1'),
+                         {self.a.pk, self.b.pk, self.c.pk})
+        self.assertEqual(self.match((x, y), 'missing<=0'), {self.a.pk})
+        self.assertEqual(self.match((z,), 'missing<=0'), {self.c.pk})
+
+    def test_missing_follows_writes(self):
+        self.assertNotIn(self.c.pk, self.match((self.x,), 'missing<=0',
+                                               max_queries=7))
+        with self.captureOnCommitCallbacks(execute=True):
+            IngredientRecipe.objects.filter(recipe=self.c).update(
+                ingredient=self.x)
+            self.c.save()
+        self.assertIn(self.c.pk, self.match((self.y,), 'missing<=1',
+                                            max_queries=7))
+        self.assertIn(self.c.pk, self.match((self.x,), 'missing<=0'))
+
+    def test_truncated(self):
+        url = (f'/api/recipes/?ingredients={self.x.pk},{self.z.pk}'
+               '&match=any')
+        self.assertNotIn('truncated', self.client.get(url).data)
+        with self.settings(RECIPE_MATCH_LIMIT=2):
+            response = self.client.get(url)
+        self.assertTrue(response.data['truncated'])
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(
+            {recipe['id'] for recipe in response.data['results']},
+            {self.b.pk, self.c.pk})
+
+    def test_seeded_recipes(self):
+        first, second = self.ingredients[3], self.ingredients[5]
+        expected = set(IngredientRecipe.objects.filter(
+            ingredient=first).values_list('recipe', flat=True)) & set(
+            IngredientRecipe.objects.filter(
+                ingredient=second).values_list('recipe', flat=True))
+        self.assertTrue(expected)
+        # Индекс загружается при первом запросе, дальше - без обращений.
+        self.assertEqual(self.match((first, second), max_queries=7), expected)
+        self.assertEqual(self.match((first, second)), expected)
+
+    def test_follows_writes(self):
+        self.assertEqual(self.match((self.x,), 'any', max_queries=7),
+                         {self.a.pk, self.b.pk})
+        # Строки ингредиентов сами отмечают рецепт измененным, как при
+        # правке в админке.
+        with self.captureOnCommitCallbacks(execute=True):
+            IngredientRecipe.objects.create(
+                recipe=self.c, ingredient=self.x, amount=1)
+            IngredientRecipe.objects.filter(
+                recipe=self.a, ingredient=self.x).delete()
+        self.assertEqual(self.match((self.x,), 'any', max_queries=7),
+                         {self.b.pk, self.c.pk})
+
+    def test_refresh_keeps_read_structures(self):
+        # match читает структуры без блокировки: обновление подменяет их,
+        # а не меняет на месте.
+        self.match((self.x,), 'missing<=1', max_queries=7)
+        data = recipe_index._data
+        snapshot = [{key: set(value) for key, value in part.items()}
+                    for part in data]
+        with self.captureOnCommitCallbacks(execute=True):
+            IngredientRecipe.objects.filter(recipe=self.c).update(
+                ingredient=self.x)
+            IngredientRecipe.objects.create(
+                recipe=self.c, ingredient=self.y, amount=1)
+        self.assertIn(self.c.pk, self.match((self.x, self.y), 'all',
+                                            max_queries=7))
+        self.assertIsNot(recipe_index._data, data)
+        self.assertEqual(
+            [{key: set(value) for key, value in part.items()}
+             for part in data], snapshot)
+
+    def test_invalid_params(self):
+        for query in ('ingredients=1,x', 'ingredients=1&match=some',
+                      'ingredients=1&match=missing<=-1'):
+            with self.subTest(query=query):
+                response = self.client.get(f'/api/recipes/?{query}')
+                self.assertEqual(
+                    response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ExplainQueriesTest(QueryBudgetTestCase):
+    def explain(self, threshold):
+        out = StringIO()
+        call_command('explain_queries', threshold=threshold, stdout=out)
+        return out.getvalue()
+
+    def test_indexed_paths_pass(self):
+        output = self.explain(threshold=10 ** 6)
+        self.assertIn('recipes: ok', output)
+        self.assertIn('download_shopping_cart: ok', output)
+
+    def test_cursor_page_is_ranged(self):
+        queries = dict(canonical_queries(self.user))
+        for name in ('recipes?cursor', 'feed?cursor'):
+            with self.subTest(name=name):
+                self.assertEqual(plan_issues(
+                    queries[name], 0, ranged=True), [])
+        # Без отдельной границы по pub_date индекс читается с начала.
+        pub_date, pk = Recipe.objects.order_by(
+            '-pub_date', '-id').values_list('pub_date', 'id')[50]
+        self.assertTrue(plan_issues(
+            Recipe.objects.order_by('-pub_date', '-id').filter(
+                Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, id__lt=pk)
+            )[:6], 0, ranged=True))
+
+    def test_flags_scans_and_sorts(self):
+        issues = plan_issues(User.objects.order_by('first_name'), 0)
+        self.assertTrue(issues)
+        with self.assertRaises(CommandError):
+            self.explain(threshold=0)
+
+
+class PerformanceMiddlewareTest(QueryBudgetTestCase):
+    def test_server_timing(self):
+        response = self.client.get('/api/recipes/')
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="5 queries"')
+        self.assertRegex(timing, r'serializer;dur=[\d.]+')
+        self.assertRegex(timing, r'total;dur=[\d.]+')
+        self.assertNotIn('n1', timing)
+
+    def test_duplicate_queries(self):
+        metrics = RequestMetrics()
+        for _ in range(3):
+            metrics.record_query(
+                lambda *args: None, 'SELECT %s', (1,), False, {})
+        self.assertEqual(metrics.duplicates(), {'SELECT %s': 3})
+        registry.observe('test-view', metrics, 0.01)
+        self.assertRegex(
+            registry.render(),
+            r'foodgram_duplicate_queries_total\{view="test-view",'
+            r'fingerprint="\w{12}"\} 2')
+
+    def test_metrics_endpoint(self):
+        self.client.get('/api/tags/')
+        response = self.client.get('/api/_metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        self.assertIn('# TYPE foodgram_request_duration_seconds histogram',
+                      body)
+        self.assertRegex(
+            body, r'foodgram_request_queries_bucket\{view="api:tags-list",'
+                  r'le="\+Inf"\} [1-9]')
+        self.assertIn('foodgram_response_cache_hits_total', body)
+
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/api/_metrics').status_code,
+                             status.HTTP_401_UNAUTHORIZED)
+            response = self.client.get(
+                '/api/_metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class AsyncViewsTest(TransactionTestCase):
+    """
+    Под ASGI эндпоинты чтения отвечают так же, как под WSGI. Пулы потоков
+    работают через свои соединения и видят только зафиксированные данные,
+    поэтому тест без общей транзакции.
+    """
+    def setUp(self):
+        ingredient_index.invalidate()
+        recipe_index.invalidate()
+        cache.clear()
+        token_cache.clear()
+        self.user = User.objects.create(
+            email='async@foodgram.ru', username='async',
+            first_name='Имя', last_name='Фамилия')
+        token = Token.objects.create(user=self.user)
+        self.tags = [
+            Tag.objects.create(name=name, color=color, slug=slug)
+            for name, color, slug in (('Завтрак', '#ffffff', 'breakfast'),
+                                      ('Обед', '#009900', 'lunch'))]
+        self.ingredients = [
+            Ingredient.objects.create(name=f'ингредиент{i}',
+                                      measurement_unit='г')
+            for i in range(3)]
+        for i in range(3):
+            recipe = Recipe.objects.create(
+                author=self.user, name=f'Рецепт{i}', text='Описание',
+                cooking_time=10)
+            recipe.tags.set(self.tags[:i + 1])
+            IngredientRecipe.objects.create(
+                recipe=recipe, ingredient=self.ingredients[i % 2],
+                amount=i + 1)
+            ShoppingCart.objects.create(user=self.user, recipe=recipe)
+        self.api_client = APIClient()
+        self.api_client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.headers = {'authorization': f'Token {token.key}'}
+
+    def get_async(self, url):
+        async def get():
+            return await self.async_client.get(url, **self.headers)
+
+        with override_settings(ROOT_URLCONF='foodgram.asgi_urls'):
+            return async_to_sync(get)()
+
+    def queries(self, response):
+        return int(re.search(
+            r'desc="(\d+) queries"', response['Server-Timing']).group(1))
+
+    def test_read_endpoints_match_wsgi(self):
+        for url in ('/api/tags/', f'/api/tags/{self.tags[0].pk}/',
+                    '/api/ingredients/?name=ингр',
+                    f'/api/ingredients/{self.ingredients[0].pk}/',
+                    '/api/recipes/', '/api/recipes/?limit=2&page=2',
+                    '/api/recipes/?cursor=', '/api/recipes/?tags=lunch'):
+            with self.subTest(url=url):
+                expected = self.api_client.get(url)
+                response = self.get_async(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.json(), expected.json())
+        self.assertIn('api_async:recipes-list', registry.duration.values)
+
+    def test_concurrent_prefetch_is_measured(self):
+        token_cache.clear()
+        expected = self.queries(self.api_client.get('/api/recipes/'))
+        token_cache.clear()
+        response = self.get_async('/api/recipes/')
+        # Запросы из потоков prefetch учтены в метриках ответа.
+        self.assertEqual(self.queries(response), expected)
+
+    def test_download_shopping_cart(self):
+        url = '/api/recipes/download_shopping_cart/'
+        for export_format in ('txt', 'csv'):
+            with self.subTest(format=export_format):
+                expected = self.api_client.get(
+                    url, {'format': export_format})
+                response = self.get_async(f'{url}?format={export_format}')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response['Content-Disposition'],
+                                 expected['Content-Disposition'])
+                self.assertEqual(response.content,
+                                 b''.join(expected.streaming_content))
+        ShoppingCart.objects.all().delete()
+        self.assertEqual(self.get_async(url).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+    def test_benchmark_handlers(self):
+        out = StringIO()
+        call_command('benchmark_handlers', '--path', '/api/tags/',
+                     '--requests', '4', '--concurrency', '2', stdout=out)
+        output = out.getvalue()
+        self.assertRegex(output, r'/api/tags/ wsgi: [\d.]+ запросов/с')
+        self.assertRegex(output, r'/api/tags/ asgi: [\d.]+ запросов/с')
+        self.assertNotIn('ошибок', output)
+
+
+class CachedTokenAuthenticationTest(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        token_cache.clear()
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def get_me(self, max_queries):
+        with self.assertBudget(max_queries):
+            return self.client.get('/api/users/me/')
+
+    def test_token_lookup_cached(self):
+        # Пользователь, затем подписка на себя для is_subscribed.
+        self.assertEqual(self.get_me(2).status_code, status.HTTP_200_OK)
+        response = self.get_me(1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['id'], self.user.pk)
+
+    def test_logout_invalidates(self):
+        self.get_me(2)
+        response = self.client.post('/api/auth/token/logout/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(
+            self.get_me(1).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivation_invalidates(self):
+        self.get_me(2)
+        user = User.objects.get(pk=self.user.pk)
+        user.is_active = False
+        user.save()
+        self.assertEqual(
+            self.get_me(1).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_cached_user_sees_list_changes(self):
+        url = '/api/recipes/?limit=3'
+        etag = self.client.get(url)['ETag']
+        self.client.post(f'/api/recipes/{self.free_recipe.pk}/favorite/')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ShoppingListBudgetTest(QueryBudgetTestCase):
+    url = '/api/recipes/download_shopping_cart/'
+
+    def download(self, export_format, max_queries=1):
+        with self.assertBudget(max_queries):
+            response = self.client.get(f'{self.url}?format={export_format}')
+            content = b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return content
+
+    def test_download_shopping_cart(self):
+        with self.assertBudget(1):
+            response = self.client.get(self.url)
+            content = b''.join(response.streaming_content).decode()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(content.startswith('Список покупок:'))
+        self.assertIn('ингредиент', content)
+
+    def test_download_csv(self):
+        lines = self.download('csv').decode().splitlines()
+        self.assertEqual(lines[0], 'name,amount,measurement_unit')
+        self.assertGreater(len(lines), 1)
+
+    def test_download_pdf(self):
+        content = self.download('pdf')
+        self.assertTrue(content.startswith(b'%PDF-1.4'))
+        self.assertTrue(content.endswith(b'%%EOF\n'))
+        startxref = int(content.rsplit(b'startxref\n', 1)[1].split()[0])
+        self.assertTrue(content[startxref:].startswith(b'xref'))
+
+    def test_unknown_format(self):
+        response = self.client.get(f'{self.url}?format=docx')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_empty_cart(self):
+        self.client.force_authenticate(self.free_author)
+        with self.assertBudget(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_shopping_list_json(self):
+        with self.assertBudget(1):
+            response = self.client.get('/api/recipes/shopping_list/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        expected = IngredientRecipe.objects.filter(
+            recipe__shopping_carts__user=self.user).values(
+                'ingredient__name').annotate(total=Sum('amount')).order_by(
+                    'ingredient__name')
+        self.assertEqual(
+            [(row['name'], row['amount']) for row in response.json()],
+            [(row['ingredient__name'], row['total']) for row in expected])
+        self.assertEqual(response.json()[0]['measurement_unit'], 'г')
+
+
+class ShoppingListTableTest(QueryBudgetTestCase):
+    """Таблица списков покупок совпадает с пересчетом после любых правок."""
+    def assertConsistent(self):
+        call_command('rebuild_shopping_lists', '--check', stdout=StringIO())
+
+    def test_cart_toggles(self):
+        recipe = self.recipes[1]
+        url = f'/api/recipes/{recipe.pk}/shopping_cart/'
+        self.client.post(url)
+        self.assertConsistent()
+        self.client.delete(url)
+        self.assertConsistent()
+        batch = '/api/recipes/shopping_cart/batch/'
+        ids = [recipe.pk for recipe in self.recipes[1:5]]
+        self.client.post(batch, {'ids': ids}, format='json')
+        self.assertConsistent()
+        self.client.delete(batch, {'ids': ids}, format='json')
+        self.assertConsistent()
+
+    def test_recipe_ingredients_edit(self):
+        recipe = self.recipes[0]
+        self.assertTrue(ShoppingCart.objects.filter(recipe=recipe).exists())
+        stored = list(recipe.ingredients.values_list(
+            'ingredient_id', 'amount'))
+        ingredients = [{'id': pk, 'amount': amount + 3}
+                       for pk, amount in stored[1:]]
+        ingredients.append({'id': self.ingredients[-1].pk, 'amount': 7})
+        self.client.force_authenticate(recipe.author)
+        response = self.client.patch(
+            f'/api/recipes/{recipe.pk}/',
+            {'ingredients': ingredients, 'tags': [self.tags[0].pk],
+             'name': recipe.name, 'text': recipe.text, 'cooking_time': 5},
+            format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertConsistent()
+
+    def test_ingredient_rows_saved_directly(self):
+        row = IngredientRecipe.objects.filter(
+            recipe__shopping_carts__isnull=False).first()
+        row.amount += 10
+        row.save()
+        self.assertConsistent()
+        row.ingredient = self.ingredients[-2]
+        row.save()
+        self.assertConsistent()
+        row.delete()
+        self.assertConsistent()
+        IngredientRecipe.objects.create(
+            recipe=row.recipe, ingredient=self.ingredients[-3], amount=4)
+        self.assertConsistent()
+
+    def test_cascades(self):
+        self.recipes[7].delete()
+        self.assertConsistent()
+        self.ingredients[0].delete()
+        self.assertConsistent()
+        self.users[1].delete()
+        self.assertConsistent()
+
+    def test_rebuild_fixes_drift(self):
+        ShoppingListItem.objects.filter(user=self.user).update(amount=1000)
+        ShoppingListItem.objects.filter(user=self.users[1]).delete()
+        with self.assertRaises(CommandError):
+            self.assertConsistent()
+        output = StringIO()
+        call_command('rebuild_shopping_lists', stdout=output)
+        self.assertIn('ShoppingListItem: исправлено строк', output.getvalue())
+        self.assertConsistent()
+
+
+class SubscriptionsBudgetTest(QueryBudgetTestCase):
+    def test_subscriptions(self):
+        self.assertListBudget('/api/users/subscriptions/', 3)
+        self.assertListBudget('/api/users/subscriptions/?recipes_limit=3', 3)
+
+    def test_recipes_preview(self):
+        for recipes_limit in (0, 2, RECIPES_PER_AUTHOR + 1):
+            response = self.client.get(
+                f'/api/users/subscriptions/?recipes_limit={recipes_limit}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            for item in response.data['results']:
+                author = User.objects.get(pk=item['id'])
+                self.assertEqual(
+                    item['recipes_count'], author.recipe.count())
+                self.assertEqual(
+                    [recipe['id'] for recipe in item['recipes']],
+                    list(author.recipe.order_by('-pub_date', '-id')[
+                        :recipes_limit].values_list('id', flat=True)))
+
+    def test_invalid_recipes_limit(self):
+        response = self.client.get(
+            '/api/users/subscriptions/?recipes_limit=много')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class FeedTest(QueryBudgetTestCase):
+    """Лента подписок совпадает с рецептами авторов из подписок."""
+    def walk(self, limit=7, max_queries=6):
+        # Лента, авторы вне раскладки, рецепты, автор, теги, ингредиенты.
+        ids = []
+        url = f'/api/recipes/feed/?limit={limit}'
+        while url:
+            with self.assertBudget(max_queries):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def expected(self, user=None):
+        return list(Recipe.objects.filter(
+            author__following__user=user or self.user).order_by(
+                '-pub_date', '-id').values_list('id', flat=True))
+
+    def test_feed(self):
+        self.assertEqual(self.walk(), self.expected())
+        self.client.force_authenticate(None)
+        response = self.client.get('/api/recipes/feed/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_fan_out_in_batches(self):
+        author = self.users[10]
+        with self.settings(FEED_FANOUT_BATCH=2):
+            with self.captureOnCommitCallbacks(execute=True):
+                recipe = Recipe.objects.create(
+                    author=author, name='Новый', text='Описание',
+                    cooking_time=5)
+        self.assertEqual(
+            set(TimelineEntry.objects.filter(recipe=recipe).values_list(
+                'user_id', flat=True)),
+            set(author.following.values_list('user_id', flat=True)))
+        self.assertEqual(self.walk()[0], recipe.pk)
+
+    def test_subscribe_backfill_and_prune(self):
+        author = self.users[1]
+        url = f'/api/users/{author.pk}/subscribe/'
+        self.client.post(url)
+        self.assertEqual(self.walk(), self.expected())
+        self.assertEqual(TimelineEntry.objects.filter(
+            user=self.user, author=author).count(), RECIPES_PER_AUTHOR)
+        self.client.delete(url)
+        self.assertEqual(self.walk(), self.expected())
+        batch = '/api/users/subscribe/batch/'
+        ids = [user.pk for user in self.users[1:4]]
+        self.client.post(batch, {'ids': ids}, format='json')
+        self.assertEqual(self.walk(), self.expected())
+        self.client.delete(batch, {'ids': ids}, format='json')
+        self.assertFalse(TimelineEntry.objects.filter(
+            user=self.user, author__in=ids).exists())
+
+    def test_merge_on_read(self):
+        # Авторы users[5:] с пятью подписчиками выше порога и читаются
+        # при запросе, users[1] по-прежнему раскладывается.
+        self.client.post(f'/api/users/{self.users[1].pk}/subscribe/')
+        with self.settings(FEED_FANOUT_LIMIT=3):
+            with self.captureOnCommitCallbacks(execute=True):
+                recipe = Recipe.objects.create(
+                    author=self.users[-1], name='Новый', text='Описание',
+                    cooking_time=5)
+            self.assertFalse(recipe.timeline_entries.exists())
+            TimelineEntry.objects.filter(
+                author__in=self.users[5:10]).delete()
+            for limit in (1, 7, 50):
+                with self.subTest(limit=limit):
+                    # Плюс рецепты авторов вне раскладки.
+                    self.assertEqual(
+                        self.walk(limit, max_queries=7), self.expected())
+
+    def test_rebuild(self):
+        TimelineEntry.objects.all().delete()
+        output = StringIO()
+        call_command('rebuild_timelines', stdout=output)
+        self.assertIn('TimelineEntry: собрано лент 5', output.getvalue())
+        self.assertEqual(self.walk(), self.expected())
+
+
+class CatalogBudgetTest(QueryBudgetTestCase):
+    def test_ingredients_search(self):
+        with self.assertBudget(1):
+            response = self.client.get('/api/ingredients/?name=ингредиент1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data)
+        with self.assertBudget(0):
+            response = self.client.get('/api/ingredients/?name=ИНГРЕДИЕНТ2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data)
+
+    def test_tags(self):
+        with self.assertBudget(1):
+            response = self.client.get('/api/tags/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_users_list(self):
+        self.assertListBudget('/api/users/', 3)
+        self.assertListBudget('/api/users/', 3, anonymous=True)
+
+
+class IngredientIndexTest(QueryBudgetTestCase):
+    def test_prefix_search(self):
+        result = ingredient_index.search('ингредиент1', limit=100)
+        self.assertEqual(
+            {item['name'] for item in result},
+            {ingredient.name for ingredient in self.ingredients
+             if ingredient.name.startswith('ингредиент1')})
+        self.assertEqual(len(ingredient_index.search('ингр', limit=5)), 5)
+        self.assertEqual(ingredient_index.search('нет такого'), [])
+
+    def test_invalidated_on_save_and_delete(self):
+        self.assertEqual(ingredient_index.search('абрикос'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            ingredient = Ingredient.objects.create(
+                name='абрикос', measurement_unit='г')
+        self.assertEqual(
+            ingredient_index.search('Абри'),
+            [{'id': ingredient.pk, 'name': 'абрикос',
+              'measurement_unit': 'г'}])
+        with self.captureOnCommitCallbacks(execute=True):
+            ingredient.delete()
+        self.assertEqual(ingredient_index.search('абрикос'), [])
+
+
+class ImportIngredientsTest(TestCase):
+    rows = (('абрикос', 'г'), ('яйцо', 'шт'), ('абрикос', 'г'),
+            ('x' * 100, 'г'))
+
+    def run_import(self, path):
+        # count, savepoint, две пачки по batch-size, release, count.
+        with self.assertNumQueries(6):
+            call_command('import_ingredients', path, '--batch-size=2',
+                         stdout=StringIO())
+
+    def assertImported(self):
+        self.assertEqual(
+            sorted(Ingredient.objects.values_list(
+                'name', 'measurement_unit')),
+            [('абрикос', 'г'), ('яйцо', 'шт')])
+
+    def test_import_csv_twice(self):
+        with TemporaryDirectory() as directory:
+            path = f'{directory}/ingredients.csv'
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write('name,measurement_unit\n')
+                file.writelines(f'{name},{unit}\n' for name, unit in self.rows)
+            self.run_import(path)
+            self.run_import(path)
+        self.assertImported()
+
+    def test_import_json(self):
+        with TemporaryDirectory() as directory:
+            path = f'{directory}/ingredients.json'
+            with open(path, 'w', encoding='utf-8') as file:
+                json.dump([{'name': name, 'measurement_unit': unit}
+                           for name, unit in self.rows], file)
+            # Маленькие блоки проверяют разбор на границах чтения.
+            with mock.patch('api.management.commands.import_ingredients.'
+                            'JSON_CHUNK_SIZE', 7):
+                self.run_import(path)
+        self.assertImported()
+
+
+class MergeDuplicateIngredientsTest(QueryBudgetTestCase):
+    def test_merge(self):
+        # Уникальность не дает создать дубль, поэтому сливаются разные
+        # ингредиенты: есть рецепты с обоими и только с одним из них.
+        source, target = self.ingredients[1], self.ingredients[0]
+        expected = dict(IngredientRecipe.objects.filter(
+            ingredient__in=(source, target)).order_by().values(
+                'recipe').annotate(total=Sum('amount')).values_list(
+                    'recipe', 'total'))
+        output = StringIO()
+        with mock.patch('api.management.commands.merge_duplicate_'
+                        'ingredients.duplicates',
+                        return_value={source.pk: target.pk}):
+            call_command('merge_duplicate_ingredients', stdout=output)
+        self.assertIn('Ingredient: удалено дублей 1', output.getvalue())
+        self.assertEqual(dict(IngredientRecipe.objects.filter(
+            ingredient=target).values_list('recipe', 'amount')), expected)
+        self.assertFalse(Ingredient.objects.filter(pk=source.pk).exists())
+        call_command('rebuild_shopping_lists', '--check', stdout=StringIO())
+
+    def test_no_duplicates(self):
+        output = StringIO()
+        call_command('merge_duplicate_ingredients', stdout=output)
+        self.assertIn('дублей нет', output.getvalue())
+
+
+class CountersTest(QueryBudgetTestCase):
+    def assertCounter(self, obj, field, value):
+        obj.refresh_from_db(fields=(field,))
+        self.assertEqual(getattr(obj, field), value)
+
+    def test_counters_follow_writes(self):
+        recipe, author = self.free_recipe, self.free_author
+        self.assertCounter(recipe, 'favorites_count', 0)
+        favorite = Favorite.objects.create(recipe=recipe, recipe_fev=author)
+        cart = ShoppingCart.objects.create(recipe=recipe, user=author)
+        self.assertCounter(recipe, 'favorites_count', 1)
+        self.assertCounter(recipe, 'shopping_carts_count', 1)
+        favorite.delete()
+        cart.delete()
+        self.assertCounter(recipe, 'favorites_count', 0)
+        self.assertCounter(recipe, 'shopping_carts_count', 0)
+
+        subscribe = Subscribe.objects.create(user=self.user, author=author)
+        new_recipe = Recipe.objects.create(
+            author=author, name='Новый', text='Описание', cooking_time=1)
+        self.assertCounter(author, 'followers_count', 1)
+        self.assertCounter(author, 'recipes_count', 1)
+        subscribe.delete()
+        new_recipe.delete()
+        self.assertCounter(author, 'followers_count', 0)
+        self.assertCounter(author, 'recipes_count', 0)
+
+    def test_recount_fixes_drift(self):
+        Recipe.objects.filter(pk=self.recipes[0].pk).update(
+            favorites_count=100)
+        User.objects.filter(pk=self.users[5].pk).update(followers_count=0)
+        output = StringIO()
+        call_command('recount_counters', stdout=output)
+        self.assertIn('Recipe.favorites_count: исправлено строк 1',
+                      output.getvalue())
+        self.assertCounter(
+            self.recipes[0], 'favorites_count',
+            self.recipes[0].favorite.count())
+        self.assertCounter(self.users[5], 'followers_count', 5)
+
+
+class ConditionalGetTest(QueryBudgetTestCase):
+    def assertNotModified(self, url, max_queries=0, **headers):
+        with self.assertBudget(max_queries):
+            response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_catalogs(self):
+        for url in ('/api/tags/', '/api/ingredients/?name=ингр'):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertNotModified(
+                    url, HTTP_IF_NONE_MATCH=response['ETag'])
+                self.assertNotModified(
+                    url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        etag = self.client.get('/api/tags/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name='Перекус', color='#0000ff', slug='snack')
+        response = self.client.get('/api/tags/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), len(self.tags) + 1)
+
+    def test_version_bumped_on_commit(self):
+        # Чтение между записью и коммитом не должно получить новую
+        # версию: другие соединения в этот момент видят старые строки.
+        tag = self.tags[0]
+        urls = ('/api/tags/', f'/api/recipes/{self.recipes[0].pk}/')
+        etags = [self.client.get(url)['ETag'] for url in urls]
+        with self.captureOnCommitCallbacks(execute=True):
+            tag.name = 'Бранч'
+            tag.save()
+            self.assertEqual(
+                [self.client.get(url)['ETag'] for url in urls], etags)
+        for url, etag in zip(urls, etags):
+            with self.subTest(url=url):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_recipe_list(self):
+        url = '/api/recipes/?limit=6'
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, HTTP_IF_NONE_MATCH=etag)
+        self.client.post(f'/api/recipes/{self.free_recipe.pk}/favorite/')
+        # Пользователь прочитан аутентификацией заново.
+        self.client.force_authenticate(User.objects.get(pk=self.user.pk))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+        self.free_recipe.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_recipe_detail(self):
+        recipe = self.recipes[0]
+        url = f'/api/recipes/{recipe.pk}/'
+        response = self.client.get(url)
+        self.assertNotModified(
+            url, 1, HTTP_IF_NONE_MATCH=response['ETag'])
+        recipe.text = 'Новое описание'
+        recipe.save()
+        response = self.client.get(
+            url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['text'], 'Новое описание')
+        self.assertEqual(
+            self.client.get('/api/recipes/0/').status_code,
+            status.HTTP_404_NOT_FOUND)
+
+    def test_recipe_detail_nested_changes(self):
+        # Переименования не меняют updated_at рецепта.
+        recipe = self.recipes[0]
+        url = f'/api/recipes/{recipe.pk}/'
+        response = self.client.get(url)
+        tag = recipe.tags.first()
+        tag.name = 'Поздний завтрак'
+        with self.captureOnCommitCallbacks(execute=True):
+            tag.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('Поздний завтрак',
+                      [item['name'] for item in response.data['tags']])
+        # Last-Modified точен до секунды.
+        time.sleep(1)
+        author = User.objects.get(pk=recipe.author_id)
+        author.first_name = 'Новое имя'
+        with self.captureOnCommitCallbacks(execute=True):
+            author.save()
+        for headers in ({'HTTP_IF_NONE_MATCH': response['ETag']},
+                        {'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']}):
+            with self.subTest(headers=list(headers)):
+                response_after = self.client.get(url, **headers)
+                self.assertEqual(
+                    response_after.status_code, status.HTTP_200_OK)
+                self.assertEqual(
+                    response_after.data['author']['first_name'], 'Новое имя')
+
+
+class AnonymousResponseCacheTest(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(None)
+
+    def test_list_cached_until_recipe_changes(self):
+        hits, misses = cache_stats.hits, cache_stats.misses
+        response = self.client.get('/api/recipes/?limit=3&tags=lunch'
+                                   '&tags=breakfast&utm=1')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        with self.assertBudget(0):
+            cached = self.client.get(
+                '/api/recipes/?tags=breakfast&limit=3&tags=lunch')
+        self.assertEqual(cached['X-Cache'], 'HIT')
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(
+            (cache_stats.hits, cache_stats.misses), (hits + 1, misses + 1))
+
+        recipe = Recipe.objects.get(pk=response.data['results'][0]['id'])
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.tags.remove(self.tags[0])
+        response = self.client.get(
+            '/api/recipes/?tags=breakfast&limit=3&tags=lunch')
+        self.assertEqual(response['X-Cache'], 'MISS')
+
+    def test_detail_cached(self):
+        url = f'/api/recipes/{self.recipes[0].pk}/'
+        self.assertEqual(self.client.get(url)['X-Cache'], 'MISS')
+        with self.assertBudget(1):
+            self.assertEqual(self.client.get(url)['X-Cache'], 'HIT')
+
+    def test_not_cached_before_commit(self):
+        # Ответ, собранный до коммита, хранится под старой версией.
+        url = '/api/recipes/?limit=3'
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.free_recipe.name = 'Переименован'
+            self.free_recipe.save()
+            self.assertEqual(self.client.get(url)['X-Cache'], 'HIT')
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][0]['name'], 'Переименован')
+
+    def test_detail_key_follows_updated_at(self):
+        recipe = self.recipes[0]
+        url = f'/api/recipes/{recipe.pk}/'
+        self.client.get(url)
+        Recipe.objects.filter(pk=recipe.pk).update(
+            text='Новое описание', updated_at=timezone.now())
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['text'], 'Новое описание')
+
+    def test_authenticated_not_cached(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/api/recipes/')
+        self.assertNotIn('X-Cache', response)
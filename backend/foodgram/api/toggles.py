@@ -0,0 +1,158 @@
+"""
+Добавление и удаление связей пользователя (избранное, корзина, подписки)
+без гонки между проверкой и записью.
+
+Добавление - один INSERT с пропуском конфликта уникальности. Он идет
+мимо save(), поэтому post_save отправляется вручную с объектом, которому
+проставлен pk вставленной строки: счетчики и отметка изменения списков
+обновляются теми же обработчиками, что и при create(). Удаление - тоже
+один DELETE, post_delete отправляется вручную только запросом, который
+действительно удалил строку.
+"""
+from itertools import chain
+
+from django.db import connections, router
+from django.db.models import AutoField
+from django.db.models.signals import post_delete, post_save
+
+BATCH_SIZE = 1000
+
+
+def can_return_rows(connection):
+    # Django 3.2 не знает, что SQLite умеет RETURNING с версии 3.35.
+    return (connection.features.can_return_rows_from_bulk_insert
+            or connection.vendor == 'sqlite'
+            and connection.Database.sqlite_version_info >= (3, 35))
+
+
+def mark_saved(obj, pk, using):
+    """Состояние объекта как после save(), см. Model.from_db."""
+    obj.pk = pk
+    obj._state.adding = False
+    obj._state.db = using
+
+
+def insert_ignoring_conflicts(objs, key=None):
+    """
+    INSERT ... ON CONFLICT DO NOTHING (INSERT OR IGNORE в SQLite) объектов
+    одной модели. Возвращает объекты, строки которых действительно
+    вставлены, с проставленным pk. Несколько объектов различаются по
+    полю key; без RETURNING они вставляются по одному с проверкой
+    rowcount, и pk не проставляется.
+    """
+    if not objs:
+        return []
+    model = type(objs[0])
+    using = router.db_for_write(model)
+    connection = connections[using]
+    ops = connection.ops
+    fields = [field for field in model._meta.concrete_fields
+              if not isinstance(field, AutoField)]
+    statement = (
+        f'{ops.insert_statement(ignore_conflicts=True)} '
+        f'{ops.quote_name(model._meta.db_table)} '
+        f'({", ".join(ops.quote_name(field.column) for field in fields)}) '
+        'VALUES {} '
+        f'{ops.ignore_conflicts_suffix_sql(ignore_conflicts=True)}')
+    placeholders = f'({", ".join(["%s"] * len(fields))})'
+    params = [
+        [field.get_db_prep_save(field.pre_save(obj, True), connection)
+         for field in fields]
+        for obj in objs]
+    with connection.cursor() as cursor:
+        if can_return_rows(connection):
+            returning = [model._meta.pk]
+            if key is not None:
+                returning.append(model._meta.get_field(key))
+            cursor.execute(
+                statement.format(', '.join([placeholders] * len(objs)))
+                + ' RETURNING '
+                + ', '.join(ops.quote_name(field.column)
+                            for field in returning),
+                list(chain.from_iterable(params)))
+            by_key = {getattr(obj, returning[-1].attname): obj
+                      for obj in objs} if key is not None else None
+            inserted = []
+            for row in cursor.fetchall():
+                obj = objs[0] if by_key is None else by_key[row[1]]
+                mark_saved(obj, row[0], using)
+                inserted.append(obj)
+            return inserted
+        inserted = []
+        for obj, values in zip(objs, params):
+            cursor.execute(statement.format(placeholders), values)
+            if cursor.rowcount == 1:
+                inserted.append(obj)
+        return inserted
+
+
+def delete_rows(model, pks):
+    """
+    DELETE по pk без сбора каскадов и сигналов - для записи, работу
+    сигналов которой вызывающий код делает сам одной дельтой.
+    """
+    pks = list(pks)
+    connection = connections[router.db_for_write(model)]
+    table = connection.ops.quote_name(model._meta.db_table)
+    column = connection.ops.quote_name(model._meta.pk.column)
+    deleted = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(pks), BATCH_SIZE):
+            batch = pks[start:start + BATCH_SIZE]
+            cursor.execute(
+                f'DELETE FROM {table} WHERE {column} IN '
+                f'({", ".join(["%s"] * len(batch))})', batch)
+            deleted += cursor.rowcount
+    return deleted
+
+
+def add_link(model, **values):
+    """Сохраненный объект связи или None, если связь уже была."""
+    inserted = insert_ignoring_conflicts([model(**values)])
+    if not inserted:
+        return None
+    instance = inserted[0]
+    using = router.db_for_write(model)
+    if instance.pk is None:
+        # СУБД без RETURNING: pk читается отдельным запросом.
+        mark_saved(instance, model.objects.filter(**values).values_list(
+            'pk', flat=True).get(), using)
+    post_save.send(sender=model, instance=instance, created=True,
+                   update_fields=None, raw=False, using=using)
+    return instance
+
+
+def remove_link(model, **values):
+    """
+    Один DELETE по значениям полей; False, если удалять было нечего.
+    post_delete отправляется, только если строку удалил этот запрос:
+    при одновременном удалении обработчики срабатывают один раз.
+    """
+    instance = model(**values)
+    using = router.db_for_write(model)
+    connection = connections[using]
+    ops = connection.ops
+    fields = [model._meta.get_field(name) for name in values]
+    statement = (
+        f'DELETE FROM {ops.quote_name(model._meta.db_table)} WHERE '
+        + ' AND '.join(f'{ops.quote_name(field.column)} = %s'
+                       for field in fields))
+    params = [field.get_db_prep_value(
+        getattr(instance, field.attname), connection) for field in fields]
+    pk = None
+    with connection.cursor() as cursor:
+        if can_return_rows(connection):
+            cursor.execute(
+                f'{statement} RETURNING '
+                f'{ops.quote_name(model._meta.pk.column)}', params)
+            row = cursor.fetchone()
+            if row is None:
+                return False
+            pk = row[0]
+        else:
+            cursor.execute(statement, params)
+            if not cursor.rowcount:
+                return False
+    mark_saved(instance, pk, using)
+    post_delete.send(sender=model, instance=instance, using=using)
+    return True
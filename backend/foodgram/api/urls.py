@@ -18,13 +18,20 @@ router.register('ingredients', views.IngredientViewSet, basename='ingredients')
 router.register(
     r'recipes/(?P<recipe_id>\d+)/shopping_cart',
     views.ShoppingCartViewSet, basename='shopping_cart')
+router.register('users', views.UserViewSet, basename='users')
 
 
 urlpatterns = [
+    path('_metrics', views.metrics),
     path(
         'recipes/download_shopping_cart/',
         views.DownloadShoppingCart.as_view()),
+    path('recipes/shopping_list/', views.ShoppingListView.as_view()),
+    path('recipes/favorite/batch/', views.FavoriteBatchView.as_view()),
+    path(
+        'recipes/shopping_cart/batch/',
+        views.ShoppingCartBatchView.as_view()),
+    path('users/subscribe/batch/', views.SubscribeBatchView.as_view()),
     path('', include(router.urls)),
-    path('', include('djoser.urls')),
     path('auth/', include('djoser.urls.authtoken')),
     path('users/<int:author_id>/subscribe/', views.SubscribeView.as_view())]
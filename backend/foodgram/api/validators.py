@@ -3,32 +3,57 @@ import re
 from django.core.exceptions import ValidationError
 
 
+def to_positive_int(value, message):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValidationError(message)
+    if number < 1:
+        raise ValidationError(message)
+    return number
+
+
+def validate_existing(ids, val_model, message):
+    """Проверяет все id одним запросом IN."""
+    found = set(
+        val_model.objects.filter(pk__in=ids).values_list('pk', flat=True))
+    missing = [pk for pk in ids if pk not in found]
+    if missing:
+        raise ValidationError(
+            f'{", ".join(map(str, missing))} - {message}')
+
+
 def validate_ingredients(ingredients_list, val_model):
+    """
+    Проверяет ингредиенты и возвращает список пар (id, количество).
+    """
     if len(ingredients_list) < 1:
         raise ValidationError(
             'Блюдо должно содержать хотя бы 1 ингредиент')
-    unique_list = []
+    amounts = {}
     for ingredient in ingredients_list:
         if not ingredient.get('id'):
             raise ValidationError('Укажите id ингредиента')
-        ingredient_id = ingredient.get('id')
-        if not val_model.objects.filter(pk=ingredient_id).exists():
-            raise ValidationError(
-                f'{ingredient_id}- ингредиент с таким id не найден')
-        if id in unique_list:
+        ingredient_id = to_positive_int(
+            ingredient.get('id'), 'Укажите id ингредиента')
+        if ingredient_id in amounts:
             raise ValidationError(
                 f'{ingredient_id}- дублирующийся ингредиент')
-        unique_list.append(ingredient_id)
-        ingredient_amount = ingredient.get('amount')
-        if int(ingredient_amount) < 1:
-            raise ValidationError(
-                f'Количество {ingredient} должно быть больше 1')
+        amounts[ingredient_id] = to_positive_int(
+            ingredient.get('amount'),
+            f'Количество {ingredient} должно быть больше 1')
+    validate_existing(
+        list(amounts), val_model, 'ингредиент с таким id не найден')
+    return list(amounts.items())
 
 
 def validate_tags(tags_list, val_model):
-    for tag in tags_list:
-        if not val_model.objects.filter(pk=tag).exists():
-            raise ValidationError(f'{tag} - Такого тэга не существует')
+    """Проверяет теги и возвращает список их id без повторов."""
+    tags = list(dict.fromkeys(
+        to_positive_int(tag, f'{tag} - Такого тэга не существует')
+        for tag in tags_list))
+    validate_existing(tags, val_model, 'Такого тэга не существует')
+    return tags
 
 
 def validate_cooking_time(value):
@@ -1,35 +1,113 @@
-from django.db.models import Sum
-from django.shortcuts import HttpResponse, get_object_or_404
+from django.conf import settings
+from django.db.models import OuterRef, Prefetch, Subquery
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.decorators import method_decorator
 from django_filters.rest_framework import DjangoFilterBackend
+from djoser.views import UserViewSet as DjoserUserViewSet
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from recipes.models import (Favorite, Ingredient, IngredientRecipe, Recipe,
-                            ShoppingCart, Tag)
+                            ShoppingCart, ShoppingListItem, Tag,
+                            TimelineEntry)
 from users.models import Subscribe, User
 
-from .filters import IngredientSearchFilter, RecipeFilter
-from .mixins import CreateDestroyViewSet
-from .paginators import PageLimitPagination
+from .conditional import (catalog_condition, recipe_condition,
+                          recipes_condition)
+from .feed import feed_recipe_ids
+from .filters import RecipeFilter
+from .ingredient_index import ingredient_index
+from .metrics import registry
+from .mixins import BatchToggleView, CreateDestroyViewSet
+from .paginators import (KeysetPageLimitPagination, PageLimitPagination,
+                         SubscriptionsPagination)
 from .permissions import IsAuthorOrReadOnly
+from .response_cache import cache_anonymous
 from .serializers import (FavoriteRecipeSerializer, IngredientSerializer,
                           RecipeSerializer, ShoppingCartSerializer,
-                          SubscribeSerializer, TagSerializer)
+                          ShoppingListSerializer, SubscribeSerializer,
+                          TagSerializer)
+from .shopping_list import (SHOPPING_LIST_FORMATS, shopping_list_queryset,
+                            shopping_list_rows)
+from .toggles import add_link, remove_link
 
 
 class RecipeViewSet(viewsets.ModelViewSet):
     """Вьюсет для просмотра списка рецептов."""
-    queryset = Recipe.objects.all()
-    pagination_class = PageLimitPagination
+    pagination_class = KeysetPageLimitPagination
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
     serializer_class = RecipeSerializer
     permission_classes = [IsAuthorOrReadOnly]
 
+    def get_queryset(self):
+        return Recipe.objects.with_user_data(
+            self.request.user,
+            relations=self.action not in (
+                'update', 'partial_update', 'destroy'))
+
+    @method_decorator(recipes_condition)
+    @cache_anonymous
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        if getattr(request, 'recipe_match_truncated', False):
+            response.data['truncated'] = True
+        return response
+
+    @method_decorator(recipe_condition)
+    @cache_anonymous
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @action(detail=False, permission_classes=(IsAuthenticated,))
+    def feed(self, request):
+        """Лента рецептов авторов из подписок, всегда по курсору."""
+        def fetch(size, after):
+            ids = feed_recipe_ids(request.user, size, after)
+            recipes = self.get_queryset().in_bulk(ids)
+            return [recipes[pk] for pk in ids if pk in recipes]
+
+        page = self.paginator.paginate_cursor(request, Recipe, fetch)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        self.reload(serializer)
+
+    def update(self, request, *args, **kwargs):
+        # Как UpdateModelMixin.update, но без сброса кеша prefetch:
+        # get_object загрузил рецепт с флагами и автором, теги и
+        # ингредиенты подгружаются один раз, уже после записи.
+        partial = kwargs.pop('partial', False)
+        serializer = self.get_serializer(
+            self.get_object(), data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        self.perform_update(serializer)
+        serializer.instance.refresh_relations()
+        return Response(serializer.data)
+
+    def reload(self, serializer):
+        """Ответ строится по рецепту с аннотациями и prefetch."""
+        serializer.instance = self.get_queryset().get(
+            pk=serializer.instance.pk)
+
+
+class UserViewSet(DjoserUserViewSet):
+    """Вьюсет пользователей с признаком подписки одним запросом."""
+    pagination_class = PageLimitPagination
+
+    def get_queryset(self):
+        return super().get_queryset().with_is_subscribed(self.request.user)
+
+
+@method_decorator(catalog_condition('tags'), name='list')
+@method_decorator(catalog_condition('tags'), name='retrieve')
 class TagViewSet(viewsets.ReadOnlyModelViewSet):
     """Вьюсет для тегов."""
     queryset = Tag.objects.all()
@@ -37,24 +115,49 @@ class TagViewSet(viewsets.ReadOnlyModelViewSet):
     pagination_class = None
 
 
+@method_decorator(catalog_condition('ingredients'), name='list')
+@method_decorator(catalog_condition('ingredients'), name='retrieve')
 class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
     """Вьюсет для ингредиентов."""
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     pagination_class = None
-    filter_backends = (IngredientSearchFilter,)
-    search_fields = ('^name',)
+
+    def list(self, request, *args, **kwargs):
+        return Response(
+            ingredient_index.search(request.query_params.get('name')))
 
 
 class SubscriptionsViewSet(viewsets.ModelViewSet):
     """Вюсет подписок."""
     serializer_class = SubscribeSerializer
     permission_classes = [IsAuthenticated, ]
-    pagination_class = PageLimitPagination
+    pagination_class = SubscriptionsPagination
+
+    def get_recipes_limit(self):
+        recipes_limit = self.request.query_params.get('recipes_limit')
+        if recipes_limit is None:
+            return None
+        try:
+            recipes_limit = int(recipes_limit)
+            if recipes_limit < 0:
+                raise ValueError
+        except ValueError:
+            raise ValidationError({
+                'errors': 'recipes_limit должен быть числом'})
+        return recipes_limit
 
     def get_queryset(self):
+        recipes = Recipe.objects.order_by('-pub_date', '-id')
+        recipes_limit = self.get_recipes_limit()
+        if recipes_limit is not None:
+            recipes = recipes.filter(pk__in=Subquery(
+                Recipe.objects.filter(author=OuterRef('author')).order_by(
+                    '-pub_date', '-id').values('pk')[:recipes_limit]))
         return Subscribe.objects.filter(
-            user=self.request.user).prefetch_related('author')
+            user=self.request.user).select_related('author').prefetch_related(
+                Prefetch('author__recipe', queryset=recipes,
+                         to_attr='recipes_preview'))
 
 
 class SubscribeView(APIView):
@@ -67,28 +170,22 @@ class SubscribeView(APIView):
             return Response(
                 {'errors': 'Вы не можете подписаться на самого себя'},
                 status=status.HTTP_400_BAD_REQUEST)
-        subscription = Subscribe.objects.filter(
-            author=author, user=request.user)
-        if subscription.exists():
+        subscription = add_link(Subscribe, author=author, user=request.user)
+        if subscription is None:
             return Response(
                 {'errors': 'Вы уже подписаны на этого автора'},
                 status=status.HTTP_400_BAD_REQUEST)
-        queryset = Subscribe.objects.create(author=author, user=request.user)
         serializer = SubscribeSerializer(
-            queryset, context={'request': request})
+            subscription, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def delete(self, request, author_id):
-        user = request.user
-        author = get_object_or_404(User, id=author_id)
-        subscription = Subscribe.objects.filter(
-            author=author, user=user)
-        if not subscription.exists():
-            return Response(
-                {'errors': 'Вы еще не подписаны на этого автора'},
-                status=status.HTTP_400_BAD_REQUEST)
-        subscription.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        if remove_link(Subscribe, author_id=author_id, user=request.user):
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        get_object_or_404(User, id=author_id)
+        return Response(
+            {'errors': 'Вы еще не подписаны на этого автора'},
+            status=status.HTTP_400_BAD_REQUEST)
 
 
 class FavoriteViewSet(viewsets.ModelViewSet):
@@ -97,28 +194,21 @@ class FavoriteViewSet(viewsets.ModelViewSet):
     serializer_class = FavoriteRecipeSerializer
     permission_classes = [IsAuthenticated, ]
 
-    def get_serializer_context(self):
-        context = super().get_serializer_context()
-        context.update({'recipe': self.kwargs.get('recipe_id')})
-        return context
-
-    def perform_create(self, serializer):
-        recipe = get_object_or_404(Recipe, pk=self.kwargs.get('recipe_id'))
-        serializer.save(
-            recipe_fev=self.request.user, recipe=recipe)
+    def create(self, request, recipe_id):
+        recipe = get_object_or_404(Recipe, pk=recipe_id)
+        favorite = add_link(Favorite, recipe=recipe, recipe_fev=request.user)
+        if favorite is None:
+            return Response({'errors': 'Рецепт уже в избранном'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        serializer = self.get_serializer(favorite)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @action(methods=('delete',), detail=True)
     def delete(self, request, recipe_id):
-        recipe = self.kwargs.get('recipe_id')
-        recipe_fev = self.request.user
-        if not Favorite.objects.filter(recipe=recipe,
-                                       recipe_fev=recipe_fev).exists():
+        if not remove_link(Favorite, recipe_id=recipe_id,
+                           recipe_fev=request.user):
             return Response({'errors': 'Рецепт не в избранном'},
                             status=status.HTTP_400_BAD_REQUEST)
-        get_object_or_404(
-            Favorite,
-            recipe_fev=recipe_fev,
-            recipe=recipe).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -128,49 +218,112 @@ class ShoppingCartViewSet(CreateDestroyViewSet):
     serializer_class = ShoppingCartSerializer
     permission_classes = [IsAuthenticated, ]
 
-    def get_serializer_context(self):
-        context = super().get_serializer_context()
-        recipe = get_object_or_404(Recipe, pk=self.kwargs.get('recipe_id'))
-        context.update({'recipe': recipe})
-        context.update({'user': self.request.user})
-        return context
+    def create(self, request, recipe_id):
+        recipe = get_object_or_404(Recipe, pk=recipe_id)
+        cart = add_link(ShoppingCart, recipe=recipe, user=request.user)
+        if cart is None:
+            return Response({'errors': 'Рецепт уже в списке покупок'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        serializer = self.get_serializer(cart)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @action(methods=('delete',), detail=True)
     def delete(self, request, recipe_id):
-        recipe = self.kwargs.get('recipe_id')
-        user = self.request.user
-        if not ShoppingCart.objects.filter(recipe=recipe,
-                                           user=user).exists():
+        if not remove_link(ShoppingCart, recipe_id=recipe_id,
+                           user=request.user):
             return Response({'errors': 'Рецепт не добавлен в список покупок'},
                             status=status.HTTP_400_BAD_REQUEST)
-        get_object_or_404(
-            ShoppingCart,
-            user=user,
-            recipe=recipe).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class FavoriteBatchView(BatchToggleView):
+    """Пакетное добавление и удаление рецептов в избранном."""
+    model = Favorite
+    target_model = Recipe
+    user_field = 'recipe_fev'
+    target_field = 'recipe'
+    counter_field = 'favorites_count'
+
+
+class ShoppingCartBatchView(BatchToggleView):
+    """Пакетное добавление и удаление рецептов в корзине покупок."""
+    model = ShoppingCart
+    target_model = Recipe
+    user_field = 'user'
+    target_field = 'recipe'
+    counter_field = 'shopping_carts_count'
+
+    def links_changed(self, user, pks, delta):
+        super().links_changed(user, pks, delta)
+        ShoppingListItem.objects.apply_delta([user.pk], {
+            pk: delta * amount for pk, amount in
+            IngredientRecipe.objects.amounts(pks).items()})
+
+
+class SubscribeBatchView(BatchToggleView):
+    """Пакетная подписка на авторов и отписка от них."""
+    model = Subscribe
+    target_model = User
+    user_field = 'user'
+    target_field = 'author'
+    counter_field = 'followers_count'
+
+    def reject(self, user, pk):
+        return 'self' if pk == user.pk else None
+
+    def links_changed(self, user, pks, delta):
+        super().links_changed(user, pks, delta)
+        if delta > 0:
+            TimelineEntry.objects.backfill(user.pk, pks)
+        else:
+            TimelineEntry.objects.prune(user.pk, pks)
+
+
 class DownloadShoppingCart(APIView):
+    """Потоковая выгрузка списка покупок в формате txt, csv или pdf."""
     permission_classes = [IsAuthenticated, ]
 
+    def perform_content_negotiation(self, request, force=False):
+        # Параметр format выбирает формат файла, а не рендерер DRF.
+        return super().perform_content_negotiation(request, force=True)
+
     def get(self, request):
-        if not ShoppingCart.objects.filter(user=request.user).exists():
+        export_format = request.query_params.get('format', 'txt')
+        if export_format not in SHOPPING_LIST_FORMATS:
+            return Response(
+                {'errors': 'Доступные форматы: '
+                           f'{", ".join(SHOPPING_LIST_FORMATS)}'},
+                status=status.HTTP_400_BAD_REQUEST)
+        render, content_type, filename = SHOPPING_LIST_FORMATS[export_format]
+        response = self.export(request.user, render, content_type)
+        if response is None:
             return Response({'errors': 'В вашем списке покупок ничего нет'},
                             status=status.HTTP_400_BAD_REQUEST)
-        rec_pk = ShoppingCart.objects.filter(
-            user=request.user).values('recipe_id')
-        ingredients = IngredientRecipe.objects.filter(
-            recipe_id__in=rec_pk).values(
-                'ingredient__name', 'ingredient__measurement_unit').annotate(
-                    amount=Sum('amount')).order_by()
-
-        text = 'Список покупок:\n\n'
-        for item in ingredients:
-            text += (f'{item["ingredient__name"]}: '
-                     f'{item["amount"]} '
-                     f'{item["ingredient__measurement_unit"]}\n')
-
-        response = HttpResponse(text, content_type='text/plain')
-        filename = 'shopping_list.txt'
         response['Content-Disposition'] = f'attachment; filename={filename}'
         return response
+
+    def export(self, user, render, content_type):
+        """Ответ с файлом или None, если корзина пуста."""
+        rows = shopping_list_rows(user)
+        if rows is None:
+            return None
+        return StreamingHttpResponse(render(rows), content_type=content_type)
+
+
+class ShoppingListView(APIView):
+    """Список покупок пользователя в JSON."""
+    permission_classes = [IsAuthenticated, ]
+
+    def get(self, request):
+        return Response(ShoppingListSerializer(
+            shopping_list_queryset(request.user), many=True).data)
+
+
+def metrics(request):
+    """Метрики процесса в текстовом формате Prometheus."""
+    if settings.METRICS_TOKEN and request.headers.get(
+            'Authorization') != f'Bearer {settings.METRICS_TOKEN}':
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    return HttpResponse(
+        registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,11 @@
+"""
+Маршруты для ASGI: эндпоинты чтения отдают асинхронные представления,
+остальные запросы проходят к обычным маршрутам.
+"""
+from django.urls import include, path
+
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path('api/', include(('api.async_urls', 'api_async'))),
+] + sync_urlpatterns
@@ -34,6 +34,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -43,7 +44,8 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'foodgram.urls'
+# asgi.py подставляет маршруты с асинхронными представлениями.
+ROOT_URLCONF = os.getenv('ROOT_URLCONF', default='foodgram.urls')
 TEMPLATES_DIR = os.path.join(BASE_DIR, "docs")
 TEMPLATES = [
     {
@@ -81,6 +83,27 @@ DATABASES = {
     }
 }
 """
+# Версии содержимого для ETag хранятся в кеше: при нескольких воркерах
+# нужен общий бэкенд, например django.core.cache.backends.filebased.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', default='foodgram'),
+    }
+}
+
+RECIPES_CACHE_TIMEOUT = 300
+
+AUTH_TOKEN_CACHE_TTL = 60
+AUTH_TOKEN_CACHE_SIZE = 10000
+# Дублировать кеш токенов в общий кеш (memcached, файловый).
+AUTH_TOKEN_SHARED_CACHE = os.getenv('AUTH_TOKEN_SHARED_CACHE') == 'True'
+
+# Если задан, /api/_metrics требует заголовок Authorization: Bearer <токен>.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -98,7 +121,7 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ),
     'DEFAULT_PAGINATION_CLASS':
         'rest_framework.pagination.PageNumberPagination',
@@ -137,5 +160,32 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+INGREDIENT_SEARCH_LIMIT = 20
+INGREDIENT_INDEX_TTL = 300
+RECIPE_INDEX_TTL = 300
+# Сколько самых новых рецептов отдает фильтр по ингредиентам; если
+# подходящих больше, в ответе списка появляется truncated: true.
+RECIPE_MATCH_LIMIT = int(os.getenv('RECIPE_MATCH_LIMIT', default=1000))
+# Лента подписок: рецепты авторов, у которых подписчиков больше
+# FEED_FANOUT_LIMIT, не раскладываются по лентам, а подмешиваются при чтении.
+FEED_FANOUT_LIMIT = int(os.getenv('FEED_FANOUT_LIMIT', default=10000))
+FEED_FANOUT_BATCH = 1000
+# Сколько последних рецептов автора попадает в ленту при подписке.
+FEED_BACKFILL = 50
+# Наибольшее число id в пакетном запросе избранного, корзины и подписок.
+BATCH_MAX_SIZE = 100
+
+SHOPPING_LIST_FONT = os.getenv(
+    'SHOPPING_LIST_FONT',
+    default='/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+
+# Потоки обработки фотографий рецептов; 0 - обработка в запросе.
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', default=2))
+IMAGE_QUALITY = 80
+
+# Потоки синхронной работы с ORM для асинхронных представлений и столько же
+# для параллельных prefetch; каждый поток держит свое соединение с базой.
+ASYNC_ORM_WORKERS = int(os.getenv('ASYNC_ORM_WORKERS', default=8))
+
 DATAFILES_DIRS = (os.path.join(BASE_DIR, 'media/'),)
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
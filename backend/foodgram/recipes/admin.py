@@ -1,12 +1,15 @@
 from django.contrib import admin
 
-from .models import (Ingredient, IngredientRecipe, Recipe, ShoppingCart,
-                     Tag, Favorite)
+from api.paginators import EstimatedCountPaginator
+
+from .models import (Favorite, Ingredient, IngredientRecipe, Recipe,
+                     ShoppingCart, Tag)
 
 
 class IngredientRecipeInline(admin.TabularInline):
     model = IngredientRecipe
     extra = 0
+    autocomplete_fields = ('ingredient',)
 
 
 @admin.register(Recipe)
@@ -21,18 +24,24 @@ class RecipeAdmin(admin.ModelAdmin):
         'pub_date'
     )
     readonly_fields = ('favorite',)
-    search_fields = ('name', 'author__username', 'tags__name')
-    list_filter = (
-        'name',
-        'author',
-    )
+    search_fields = ('name', 'author__username')
+    list_filter = ('tags', 'pub_date')
+    list_select_related = ('author',)
+    autocomplete_fields = ('author',)
     inlines = (IngredientRecipeInline,)
     ordering = ('name',)
     empty_value_display = '-пусто-'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        form.instance.update_search_document()
 
     def favorite(self, obj):
-        return obj.favorite.all().count()
+        return obj.favorites_count
     favorite.short_description = 'Раз в избранном'
+    favorite.admin_order_field = 'favorites_count'
 
 
 @admin.register(Tag)
@@ -62,9 +71,10 @@ class IngredientAdmin(admin.ModelAdmin):
     search_fields = (
         'name',
     )
-    list_filter = ('name', )
+    list_filter = ('measurement_unit', )
     empty_value_display = '-пусто-'
     ordering = ('name',)
+    show_full_result_count = False
 
 
 @admin.register(IngredientRecipe)
@@ -79,7 +89,19 @@ class IngredientRecipeAdmin(admin.ModelAdmin):
         'recipe__name',
         'ingredient__name',
     )
+    list_select_related = ('recipe', 'ingredient')
+    autocomplete_fields = ('recipe', 'ingredient')
     empty_value_display = '-пусто-'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        obj.recipe.update_search_document()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        obj.recipe.update_search_document()
 
 
 @admin.register(ShoppingCart)
@@ -93,16 +115,27 @@ class ShoppingCartAdmin(admin.ModelAdmin):
     search_fields = (
         'recipe__name',
         'user__username',
-        'date_added',
     )
-    list_filter = ('user',)
+    list_filter = ('date_added',)
+    list_select_related = ('recipe', 'user')
+    autocomplete_fields = ('recipe', 'user')
     empty_value_display = '-пусто-'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Favorite)
-class Favorite(admin.ModelAdmin):
+class FavoriteAdmin(admin.ModelAdmin):
+    """Панель управления избранными рецептами"""
     list_display = (
         'recipe',
         'recipe_fev',
     )
-    list_filter = ('recipe_fev',)
+    search_fields = (
+        'recipe__name',
+        'recipe_fev__username',
+    )
+    list_select_related = ('recipe', 'recipe_fev')
+    autocomplete_fields = ('recipe', 'recipe_fev')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
@@ -1,9 +1,23 @@
+from collections import defaultdict
+
+from django.conf import settings
 from django.core import validators
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models import (BooleanField, Case, Exists, F, IntegerField,
+                              OuterRef, Prefetch, Subquery, Sum, Value,
+                              When, prefetch_related_objects)
+from django.db.models.functions import Greatest
 
 from api.validators import validate_ingredient_name
-from users.models import User
+from users.models import Subscribe, User
+
+from .search import search_recipes
+
+
+def build_search_document(name, text, ingredient_names):
+    """Текст для полнотекстового поиска: название, описание, ингредиенты."""
+    return '\n'.join((name, text, *ingredient_names))
 
 
 class Ingredient(models.Model):
@@ -20,6 +34,12 @@ class Ingredient(models.Model):
     class Meta:
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
+        constraints = (
+            models.UniqueConstraint(
+                fields=('name', 'measurement_unit'),
+                name='unique_ingredient',
+            ),
+        )
 
     def __str__(self):
         return self.name
@@ -56,6 +76,62 @@ class Tag(models.Model):
         return self.name
 
 
+def relation_prefetches():
+    """Теги и строки ингредиентов вместе с ингредиентами."""
+    return (
+        'tags',
+        Prefetch(
+            'ingredients',
+            queryset=IngredientRecipe.objects.select_related('ingredient')))
+
+
+class RecipeQuerySet(models.QuerySet):
+    """
+    Набор запросов рецептов с флагами текущего пользователя.
+    """
+    def with_user_data(self, user, relations=True):
+        """
+        Аннотирует is_favorited и is_in_shopping_cart через Exists и
+        подгружает автора (с is_subscribed), теги и ингредиенты
+        фиксированным числом запросов. relations=False - без тегов и
+        ингредиентов, для записи, после которой они читаются заново.
+        """
+        if user.is_anonymous:
+            false = Value(False, output_field=BooleanField())
+            queryset = self.annotate(
+                is_favorited=false, is_in_shopping_cart=false)
+        else:
+            queryset = self.annotate(
+                is_favorited=Exists(Favorite.objects.filter(
+                    recipe=OuterRef('pk'), recipe_fev=user)),
+                is_in_shopping_cart=Exists(ShoppingCart.objects.filter(
+                    recipe=OuterRef('pk'), user=user)))
+        queryset = queryset.prefetch_related(Prefetch(
+            'author', queryset=User.objects.with_is_subscribed(user)))
+        if relations:
+            queryset = queryset.prefetch_related(*relation_prefetches())
+        return queryset
+
+    def search(self, query):
+        """Рецепты по запросу, отсортированные по релевантности."""
+        return search_recipes(self, query)
+
+    def refresh_search_documents(self):
+        """Пересобирает поисковый текст рецептов из набора."""
+        recipes = list(self.order_by().only('id', 'name', 'text'))
+        names = defaultdict(list)
+        for recipe_id, name in IngredientRecipe.objects.filter(
+                recipe__in=[recipe.pk for recipe in recipes]).order_by(
+                    'ingredient__name').values_list(
+                        'recipe_id', 'ingredient__name'):
+            names[recipe_id].append(name)
+        for recipe in recipes:
+            recipe.search_document = build_search_document(
+                recipe.name, recipe.text, names[recipe.pk])
+        Recipe.objects.bulk_update(recipes, ['search_document'])
+        return len(recipes)
+
+
 class Recipe(models.Model):
     author = models.ForeignKey(
         User, on_delete=models.CASCADE,
@@ -68,6 +144,9 @@ class Recipe(models.Model):
         null=True,
         default=None,
         verbose_name='Фотография блюда')
+    image_variants = models.JSONField(
+        default=dict, blank=True, editable=False,
+        verbose_name='Уменьшенные копии фотографии')
     text = models.TextField(
         verbose_name='Описание')
     tags = models.ManyToManyField(
@@ -80,6 +159,17 @@ class Recipe(models.Model):
             MaxValueValidator(600, 'Что-то долго готовится')])
     pub_date = models.DateTimeField(
         auto_now_add=True, verbose_name='Дата публикации')
+    updated_at = models.DateTimeField(
+        auto_now=True, verbose_name='Дата изменения')
+    favorites_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name='Раз в избранном')
+    shopping_carts_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name='Раз в списке покупок')
+    search_document = models.TextField(
+        blank=True, default='', editable=False,
+        verbose_name='Текст для поиска')
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         ordering = ['-pub_date', ]
@@ -89,10 +179,49 @@ class Recipe(models.Model):
             models.UniqueConstraint(fields=['author', 'name'],
                                     name='unique_author_recipename')
         ]
+        indexes = (
+            models.Index(fields=('-pub_date', '-id'), name='recipe_feed_idx'),
+            models.Index(fields=('author', '-pub_date', '-id'),
+                         name='recipe_author_feed_idx'),
+            models.Index(fields=('updated_at',),
+                         name='recipe_updated_at_idx'),
+        )
 
     def __str__(self):
         return self.name
 
+    def ingredient_names(self):
+        if self.pk is None:
+            return ()
+        return IngredientRecipe.objects.filter(recipe=self).order_by(
+            'ingredient__name').values_list('ingredient__name', flat=True)
+
+    def refresh_relations(self):
+        """Заново подгружает теги и ингредиенты после их записи."""
+        cache = getattr(self, '_prefetched_objects_cache', {})
+        cache.pop('tags', None)
+        cache.pop('ingredients', None)
+        prefetch_related_objects([self], *relation_prefetches())
+
+    def save(self, *args, **kwargs):
+        self.search_document = build_search_document(
+            self.name, self.text, self.ingredient_names())
+        super().save(*args, **kwargs)
+
+    def update_search_document(self):
+        """Обновляет поисковый текст после записи ингредиентов."""
+        self.search_document = build_search_document(
+            self.name, self.text, self.ingredient_names())
+        Recipe.objects.filter(pk=self.pk).update(
+            search_document=self.search_document)
+
+
+class IngredientRecipeQuerySet(models.QuerySet):
+    def amounts(self, recipe_ids):
+        """Сумма каждого ингредиента по рецептам: {id ингредиента: сумма}."""
+        return dict(self.filter(recipe__in=recipe_ids).order_by().values_list(
+            'ingredient_id').annotate(total=Sum('amount')))
+
 
 class IngredientRecipe(models.Model):
     ingredient = models.ForeignKey(
@@ -112,6 +241,8 @@ class IngredientRecipe(models.Model):
         verbose_name='Количество',
     )
 
+    objects = IngredientRecipeQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Ингредиент в рецепте'
         verbose_name_plural = 'Ингредиенты в рецептах'
@@ -157,6 +288,10 @@ class ShoppingCart(models.Model):
                 name='unique_recipe_shopping cart'
             ),
         )
+        indexes = (
+            models.Index(fields=('user', 'recipe'),
+                         name='shopping_cart_user_idx'),
+        )
 
     def __str__(self) -> str:
         """Метод строкового представления модели."""
@@ -184,6 +319,174 @@ class Favorite(models.Model):
                 name='unique_favorite'
             ),
         )
+        indexes = (
+            models.Index(fields=('recipe_fev', 'recipe'),
+                         name='favorite_user_idx'),
+        )
 
     def __str__(self):
         return f'{self.recipe.name} в избранном у {self.recipe_fev.username}'
+
+
+class ShoppingListQuerySet(models.QuerySet):
+    def apply_delta(self, user_ids, deltas):
+        """
+        Прибавляет дельты {id ингредиента: количество} к спискам
+        пользователей. Строки создаются только для положительных дельт,
+        обнуленные остаются до rebuild_shopping_lists: удаление строки
+        могло бы потерять параллельное прибавление к ней.
+        """
+        deltas = {pk: delta for pk, delta in deltas.items() if delta}
+        if not user_ids or not deltas:
+            return
+        added = [pk for pk, delta in deltas.items() if delta > 0]
+        if added:
+            self.bulk_create(
+                (ShoppingListItem(user_id=user_id, ingredient_id=pk)
+                 for user_id in user_ids for pk in added),
+                ignore_conflicts=True)
+        self.filter(user__in=user_ids, ingredient__in=list(deltas)).update(
+            amount=Greatest(F('amount') + Case(
+                *(When(ingredient_id=pk, then=Value(delta))
+                  for pk, delta in deltas.items()),
+                default=Value(0), output_field=IntegerField()), 0))
+
+    def apply_recipe_delta(self, recipe_id, deltas):
+        """Дельта ингредиентов рецепта всем, у кого он в корзине."""
+        if not any(deltas.values()):
+            return
+        self.apply_delta(list(ShoppingCart.objects.filter(
+            recipe_id=recipe_id).values_list('user_id', flat=True)), deltas)
+
+
+class ShoppingListItem(models.Model):
+    """
+    Сумма ингредиента по всем рецептам в корзине пользователя.
+
+    Поддерживается дельтами при изменении корзины и ингредиентов рецептов;
+    rebuild_shopping_lists пересчитывает таблицу и проверяет ее.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='Владелец списка',
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shopping_list_items',
+        verbose_name='Ингредиент',
+    )
+    amount = models.PositiveIntegerField(
+        default=0, verbose_name='Количество')
+
+    objects = ShoppingListQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Строка списка покупок'
+        verbose_name_plural = 'Списки покупок'
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'ingredient'),
+                name='unique_shopping_list_item'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.user_id} {self.ingredient_id} {self.amount}'
+
+
+class TimelineQuerySet(models.QuerySet):
+    """
+    Ленты подписок: рецепт раскладывается по лентам подписчиков при
+    публикации. Авторы с числом подписчиков больше FEED_FANOUT_LIMIT
+    не раскладываются, их рецепты подмешиваются при чтении ленты.
+    """
+    def fan_out(self, recipe):
+        """Рецепт в ленты подписчиков автора пачками по FEED_FANOUT_BATCH."""
+        followers = Subscribe.objects.filter(
+            author_id=recipe.author_id,
+            author__followers_count__lte=settings.FEED_FANOUT_LIMIT)
+        last = 0
+        while True:
+            batch = list(followers.filter(id__gt=last).order_by(
+                'id').values_list('id', 'user_id')[
+                    :settings.FEED_FANOUT_BATCH])
+            if not batch:
+                return
+            self.bulk_create(
+                (TimelineEntry(user_id=user_id, recipe_id=recipe.pk,
+                               author_id=recipe.author_id,
+                               pub_date=recipe.pub_date)
+                 for _, user_id in batch),
+                ignore_conflicts=True)
+            last = batch[-1][0]
+
+    def backfill(self, user_id, author_ids):
+        """Последние FEED_BACKFILL рецептов каждого автора в ленту."""
+        recipes = Recipe.objects.filter(
+            author__in=author_ids,
+            author__followers_count__lte=settings.FEED_FANOUT_LIMIT,
+            pk__in=Subquery(Recipe.objects.filter(
+                author=OuterRef('author')).order_by(
+                    '-pub_date', '-id').values('pk')[
+                        :settings.FEED_BACKFILL]))
+        self.bulk_create(
+            (TimelineEntry(user_id=user_id, recipe_id=pk,
+                           author_id=author_id, pub_date=pub_date)
+             for pk, author_id, pub_date in recipes.order_by().values_list(
+                 'pk', 'author_id', 'pub_date')),
+            ignore_conflicts=True)
+
+    def prune(self, user_id, author_ids):
+        """Убирает из ленты рецепты авторов, от которых отписались."""
+        self.filter(user_id=user_id, author__in=author_ids).delete()
+
+
+class TimelineEntry(models.Model):
+    """
+    Рецепт в ленте подписок пользователя. Автор и дата публикации
+    скопированы из рецепта: страница ленты читается одним проходом
+    по индексу, а отписка удаляет строки автора без соединений.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='timeline',
+        verbose_name='Читатель',
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='timeline_entries',
+        verbose_name='Рецепт',
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Автор',
+    )
+    pub_date = models.DateTimeField(verbose_name='Дата публикации')
+
+    objects = TimelineQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Ленты подписок'
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'recipe'),
+                name='unique_timeline_entry'
+            ),
+        )
+        indexes = (
+            models.Index(fields=('user', '-pub_date', '-recipe'),
+                         name='timeline_user_idx'),
+            models.Index(fields=('user', 'author'),
+                         name='timeline_author_idx'),
+        )
+
+    def __str__(self):
+        return f'{self.recipe_id} в ленте {self.user_id}'
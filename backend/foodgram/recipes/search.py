@@ -0,0 +1,96 @@
+"""
+Полнотекстовый поиск по полю search_document рецептов.
+
+В PostgreSQL (12+) поиск идет по хранимому столбцу tsvector с индексом
+GIN, в SQLite - по внешней таблице FTS5, которую поддерживают триггеры.
+Миграции создаются при развертывании, поэтому эти объекты создает
+обработчик post_migrate; на остальных СУБД поиск сводится к icontains.
+"""
+import re
+
+from django.db import connections
+from django.db.models import BooleanField, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+SEARCH_CONFIG = 'russian'
+TABLE = 'recipes_recipe'
+FTS_TABLE = 'recipes_recipe_fts'
+
+POSTGRESQL_SETUP = (
+    f'ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS search_vector tsvector '
+    f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', search_document)) "
+    'STORED',
+    f'CREATE INDEX IF NOT EXISTS {TABLE}_search_idx ON {TABLE} '
+    'USING gin (search_vector)',
+)
+SQLITE_SETUP = (
+    f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5('
+    f"search_document, content='{TABLE}', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON {TABLE} '
+    f'BEGIN INSERT INTO {FTS_TABLE}(rowid, search_document) '
+    'VALUES (new.id, new.search_document); END',
+    f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON {TABLE} '
+    f'BEGIN INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, search_document) '
+    "VALUES ('delete', old.id, old.search_document); END",
+    f'CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update '
+    f'AFTER UPDATE OF search_document ON {TABLE} '
+    f'BEGIN INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, search_document) '
+    "VALUES ('delete', old.id, old.search_document); "
+    f'INSERT INTO {FTS_TABLE}(rowid, search_document) '
+    'VALUES (new.id, new.search_document); END',
+    # Таблица могла быть пересоздана миграцией вместе с триггерами.
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+)
+SETUP = {'postgresql': POSTGRESQL_SETUP, 'sqlite': SQLITE_SETUP}
+
+
+def install_search_index(using='default', **kwargs):
+    """Создает поисковый индекс; вызывается после каждой миграции."""
+    connection = connections[using]
+    statements = SETUP.get(connection.vendor)
+    if not statements:
+        return
+    with connection.cursor() as cursor:
+        if TABLE not in connection.introspection.table_names(cursor):
+            return
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def search_words(query):
+    return re.findall(r'\w+', query.lower())
+
+
+def search_recipes(queryset, query):
+    words = search_words(query)
+    if not words:
+        return queryset.none()
+    vendor = connections[queryset.db].vendor
+    if vendor == 'postgresql':
+        tsquery = f"plainto_tsquery('{SEARCH_CONFIG}', %s)"
+        text = ' '.join(words)
+        match = RawSQL(
+            f'{TABLE}.search_vector @@ {tsquery}', (text,),
+            output_field=BooleanField())
+        rank = RawSQL(
+            f'ts_rank({TABLE}.search_vector, {tsquery})', (text,),
+            output_field=FloatField())
+    elif vendor == 'sqlite':
+        # Каждое слово ищется как префикс, слова объединяются через AND.
+        fts_query = ' '.join(f'"{word}"*' for word in words)
+        match = RawSQL(
+            f'{TABLE}.id IN (SELECT rowid FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s)', (fts_query,),
+            output_field=BooleanField())
+        rank = RawSQL(
+            f'(SELECT -bm25({FTS_TABLE}) FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s AND rowid = {TABLE}.id)',
+            (fts_query,), output_field=FloatField())
+    else:
+        match = Q()
+        for word in words:
+            match &= Q(search_document__icontains=word)
+        rank = Value(0.0, output_field=FloatField())
+    return queryset.filter(match).annotate(search_rank=rank).order_by(
+        '-search_rank', '-pub_date', '-id')
@@ -0,0 +1,120 @@
+from collections import Counter
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from users.models import Subscribe, User, change_counter, touch_lists
+
+from .models import (Favorite, Ingredient, IngredientRecipe, Recipe,
+                     ShoppingCart, ShoppingListItem, TimelineEntry)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_created(instance, created, **kwargs):
+    if created:
+        change_counter(User, instance.author_id, 'recipes_count', 1)
+        # Раскладка по лентам после коммита: подписчиков может быть много,
+        # а откат транзакции не должен оставлять записей в лентах.
+        transaction.on_commit(
+            partial(TimelineEntry.objects.fan_out, instance))
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_renamed(instance, created, **kwargs):
+    if not created:
+        Recipe.objects.filter(
+            ingredients__ingredient=instance).refresh_search_documents()
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(instance, **kwargs):
+    change_counter(User, instance.author_id, 'recipes_count', -1)
+
+
+@receiver(post_save, sender=Favorite)
+def favorite_created(instance, created, **kwargs):
+    if created:
+        change_counter(Recipe, instance.recipe_id, 'favorites_count', 1)
+        touch_lists(instance.recipe_fev_id)
+
+
+@receiver(post_delete, sender=Favorite)
+def favorite_deleted(instance, **kwargs):
+    change_counter(Recipe, instance.recipe_id, 'favorites_count', -1)
+    touch_lists(instance.recipe_fev_id)
+
+
+@receiver(post_save, sender=ShoppingCart)
+def shopping_cart_created(instance, created, **kwargs):
+    if created:
+        change_counter(Recipe, instance.recipe_id, 'shopping_carts_count', 1)
+        touch_lists(instance.user_id)
+        ShoppingListItem.objects.apply_delta(
+            [instance.user_id],
+            IngredientRecipe.objects.amounts([instance.recipe_id]))
+
+
+@receiver(post_delete, sender=ShoppingCart)
+def shopping_cart_deleted(instance, **kwargs):
+    change_counter(Recipe, instance.recipe_id, 'shopping_carts_count', -1)
+    touch_lists(instance.user_id)
+    # При удалении рецепта его ингредиенты могут быть уже удалены; тогда
+    # их вычел ingredient_amount_deleted, пока корзина еще была.
+    ShoppingListItem.objects.apply_delta([instance.user_id], {
+        pk: -amount for pk, amount in IngredientRecipe.objects.amounts(
+            [instance.recipe_id]).items()})
+
+
+@receiver(pre_save, sender=IngredientRecipe)
+def ingredient_amount_saving(instance, **kwargs):
+    # Сохраненная строка нужна, чтобы вычесть ее из списков покупок.
+    instance.stored_row = None
+    if instance.pk:
+        instance.stored_row = IngredientRecipe.objects.filter(
+            pk=instance.pk).values_list(
+                'recipe_id', 'ingredient_id', 'amount').first()
+
+
+@receiver(post_save, sender=IngredientRecipe)
+def ingredient_amount_saved(instance, **kwargs):
+    deltas = {instance.recipe_id: Counter(
+        {instance.ingredient_id: instance.amount})}
+    stored_row = getattr(instance, 'stored_row', None)
+    if stored_row is not None:
+        recipe_id, ingredient_id, amount = stored_row
+        deltas.setdefault(recipe_id, Counter())[ingredient_id] -= amount
+    for recipe_id, delta in deltas.items():
+        ShoppingListItem.objects.apply_recipe_delta(recipe_id, delta)
+
+
+@receiver(post_delete, sender=IngredientRecipe)
+def ingredient_amount_deleted(instance, **kwargs):
+    ShoppingListItem.objects.apply_recipe_delta(
+        instance.recipe_id, {instance.ingredient_id: -instance.amount})
+
+
+@receiver((post_save, post_delete), sender=IngredientRecipe)
+def recipe_ingredients_changed(instance, **kwargs):
+    # Индекс рецептов по ингредиентам дочитывает рецепты по updated_at,
+    # а строки из админки и прямые save() сам рецепт не трогают.
+    recipe_ids = {instance.recipe_id}
+    stored_row = getattr(instance, 'stored_row', None)
+    if stored_row is not None:
+        recipe_ids.add(stored_row[0])
+    Recipe.objects.filter(pk__in=recipe_ids).update(
+        updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Subscribe)
+def timeline_subscribed(instance, created, **kwargs):
+    if created:
+        TimelineEntry.objects.backfill(
+            instance.user_id, [instance.author_id])
+
+
+@receiver(post_delete, sender=Subscribe)
+def timeline_unsubscribed(instance, **kwargs):
+    TimelineEntry.objects.prune(instance.user_id, [instance.author_id])
@@ -1,5 +1,7 @@
 from django.contrib import admin
 
+from api.paginators import EstimatedCountPaginator
+
 from .models import Subscribe, User
 
 
@@ -10,18 +12,22 @@ class UserAdmin(admin.ModelAdmin):
         'username',
         'email',
         'first_name',
-        'last_name'
+        'last_name',
+        'recipes_count',
+        'followers_count',
     )
     search_fields = (
         'username',
         'email',
     )
     list_filter = (
-        'username',
-        'email'
+        'is_active',
+        'is_staff',
     )
     ordering = ('username',)
     empty_value_display = '-пусто-'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Subscribe)
@@ -33,5 +39,8 @@ class SubscriptionAdmin(admin.ModelAdmin):
         'user__username',
         'user__email'
     ]
-    list_filter = ['author__username', 'user__username']
+    list_select_related = ['user', 'author']
+    autocomplete_fields = ['user', 'author']
     empty_value_display = '-пусто-'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
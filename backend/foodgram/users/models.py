@@ -1,5 +1,54 @@
-from django.contrib.auth.models import AbstractUser
+from django.conf import settings
+from django.contrib.auth.models import AbstractUser, UserManager
+from django.core.cache import cache
 from django.db import models
+from django.db.models import BooleanField, Exists, F, OuterRef, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+
+def change_counter(model, pk, field, delta):
+    """Атомарно изменяет счетчик в базе, не читая строку."""
+    model.objects.filter(pk=pk).update(
+        **{field: Greatest(F(field) + delta, 0)})
+
+
+def change_counters(model, pks, field, delta):
+    """Меняет счетчик у нескольких строк одним запросом."""
+    model.objects.filter(pk__in=pks).update(
+        **{field: Greatest(F(field) + delta, 0)})
+
+
+LISTS_MODIFIED_KEY = 'lists-modified:{}'
+
+
+def touch_lists(user_id):
+    """
+    Отмечает изменение избранного, корзины или подписок.
+
+    Отметка дублируется в кеш на время жизни кеша аутентификации: пока
+    запись жива, пользователь из этого кеша может нести старое значение.
+    """
+    now = timezone.now()
+    User.objects.filter(pk=user_id).update(lists_modified=now)
+    cache.set(LISTS_MODIFIED_KEY.format(user_id), now,
+              settings.AUTH_TOKEN_CACHE_TTL)
+
+
+class UserQuerySet(models.QuerySet):
+    """
+    Набор запросов пользователей с признаком подписки.
+    """
+    def with_is_subscribed(self, user):
+        if user.is_anonymous:
+            return self.annotate(
+                is_subscribed=Value(False, output_field=BooleanField()))
+        return self.annotate(is_subscribed=Exists(
+            Subscribe.objects.filter(user=user, author=OuterRef('pk'))))
+
+
+class FoodgramUserManager(UserManager.from_queryset(UserQuerySet)):
+    pass
 
 
 class User(AbstractUser):
@@ -24,6 +73,15 @@ class User(AbstractUser):
         max_length=150,
         help_text='Ваша фамилия'
         )
+    recipes_count = models.PositiveIntegerField(
+        verbose_name='Число рецептов', default=0, editable=False)
+    followers_count = models.PositiveIntegerField(
+        verbose_name='Число подписчиков', default=0, editable=False)
+    lists_modified = models.DateTimeField(
+        verbose_name='Изменение избранного, корзины и подписок',
+        null=True, editable=False)
+
+    objects = FoodgramUserManager()
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
@@ -61,6 +119,9 @@ class Subscribe(models.Model):
                 name='unique_subscribe'
             )
         ]
+        indexes = [
+            models.Index(fields=['user', 'id'], name='subscribe_user_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user.username} {self.author.username}'
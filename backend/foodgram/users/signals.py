@@ -0,0 +1,17 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Subscribe, User, change_counter, touch_lists
+
+
+@receiver(post_save, sender=Subscribe)
+def subscribe_created(instance, created, **kwargs):
+    if created:
+        change_counter(User, instance.author_id, 'followers_count', 1)
+        touch_lists(instance.user_id)
+
+
+@receiver(post_delete, sender=Subscribe)
+def subscribe_deleted(instance, **kwargs):
+    change_counter(User, instance.author_id, 'followers_count', -1)
+    touch_lists(instance.user_id)
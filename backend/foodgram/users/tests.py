@@ -1,3 +1,39 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
-# Create your tests here.
+from users.models import Subscribe, User
+
+
+class AdminChangelistTest(TestCase):
+    """Число запросов страниц админки не зависит от числа строк."""
+    urls = ('/admin/users/user/', '/admin/users/subscribe/')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(
+            email='admin@foodgram.ru', username='admin', password='admin',
+            first_name='Админ', last_name='Админ')
+
+    def add_rows(self, count):
+        start = User.objects.count()
+        for number in range(start, start + count):
+            user = User.objects.create(
+                email=f'user{number}@foodgram.ru', username=f'user{number}',
+                first_name='Имя', last_name='Фамилия')
+            Subscribe.objects.create(user=user, author=self.admin)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_changelist_queries_constant(self):
+        self.client.force_login(self.admin)
+        self.add_rows(2)
+        before = {url: self.count_queries(url) for url in self.urls}
+        self.add_rows(10)
+        for url in self.urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.count_queries(url), before[url])